@@ -0,0 +1,67 @@
+# Compare the old decrypt-and-catch loop used by export.try_decrypt with
+# crypto.decrypt_batch.
+# Usage: python -m benchmarks.crypto_bench [-n CHAPTERS] [-s SIZE] [-w WRONG]
+from argparse import ArgumentParser
+from base64 import b64decode
+from hashlib import sha256
+from random import Random
+from time import perf_counter
+from Crypto.Cipher import AES
+from crypto import decrypt_batch, encrypt
+
+
+def legacy_decrypt(encrypted, key):
+    if isinstance(key, str):
+        key = key.encode()
+    ekey = sha256(key).digest()
+    aes = AES.new(ekey, AES.MODE_CBC, b'\0' * 16)
+    data = aes.decrypt(b64decode(encrypted))
+    return data[0:len(data) - ord(chr(data[len(data) - 1]))]
+
+
+def legacy_try_decrypt(content, keys):
+    for key in keys:
+        try:
+            return legacy_decrypt(content, key).decode()
+        except Exception:
+            pass
+
+
+def random_key(r: Random):
+    return ''.join(r.choice('0123456789abcdef') for _ in range(32))
+
+
+def main(args=None):
+    parser = ArgumentParser(description='Benchmark chapter decryption.')
+    parser.add_argument('-n', '--chapters', type=int, default=2000)
+    parser.add_argument('-s', '--size', type=int, default=3000, help='Characters per chapter.')  # noqa: E501
+    parser.add_argument('-w', '--wrong', type=int, default=1, help='Wrong keys tried before the right one.')  # noqa: E501
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    arg = parser.parse_args(args)
+    r = Random(0)
+    items = []
+    for _ in range(arg.chapters):
+        key = random_key(r)
+        text = ''.join(chr(r.randint(0x4e00, 0x9fa5)) for _ in range(arg.size))
+        keys = [random_key(r) for _ in range(arg.wrong)] + [key]
+        items.append((encrypt(text, key), keys))
+    expected = None
+    for name, fn in [
+        ('legacy', lambda: [legacy_try_decrypt(c, k) for c, k in items]),
+        ('decrypt_batch', lambda: decrypt_batch(items)),
+    ]:
+        best = None
+        for _ in range(arg.repeat):
+            start = perf_counter()
+            result = fn()
+            t = perf_counter() - start
+            best = t if best is None else min(best, t)
+        if expected is None:
+            expected = result
+        elif result != expected:
+            raise ValueError(f'{name} returned different plaintext.')
+        print(f'{name}: {best:.3f}s ({arg.chapters / best:.0f} chapters/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# Time main.py actions against synthetic libraries of several sizes and
+# append the results to a JSON lines history file, so runs on different
+# commits can be compared.
+# Usage: python -m benchmarks.e2e_bench [-r REPEAT] [-o HISTORY] [SIZE ...]
+# SIZE is BOOKSxCHAPTERS, like 10x100.
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from os.path import abspath, dirname, exists, join
+from os import makedirs
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import platform
+import sqlite3
+import subprocess
+import sys
+from benchmarks.fixture import FIRST_BOOK_ID, ImageServer, generate
+
+
+ROOT = dirname(dirname(abspath(__file__)))
+MAIN = join(ROOT, 'main.py')
+DEFAULT_SIZES = ['1x200', '10x100', '50x100']
+# (name, action arguments). Export steps run with the keys imported and the
+# image cache filled by the setup. <chapter_id> is a downloaded chapter.
+STEPS = [
+    ('import_keys', ['ik']),
+    ('warm_image_cache', ['wic']),
+    ('export_chapter', ['ec', '-C', '<chapter_id>']),
+    ('export_book_txt', ['eb', '-B', str(FIRST_BOOK_ID), '-t', 'txt']),
+    ('export_book_epub_inline', ['eb', '-B', str(FIRST_BOOK_ID), '-t', 'epub', '-i', 'inline']),  # noqa: E501
+    ('export_book_epub_footnote', ['eb', '-B', str(FIRST_BOOK_ID), '-t', 'epub', '-i', 'footnote']),  # noqa: E501
+    ('export_all', ['ea', '-t', 'epub,txt', '-i', 'inline', '-I', 'false']),
+]
+# Steps which change the state used by the next run of the same step.
+FRESH_STEPS = ['import_keys', 'warm_image_cache']
+
+
+def parse_size(s: str):
+    books, _, chapters = s.lower().partition('x')
+    return int(books), int(chapters)
+
+
+def get_commit():
+    try:
+        p = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                           text=True, check=True)
+        return p.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_downloaded_chapter(cwmdb: str):
+    db = sqlite3.connect(cwmdb)
+    try:
+        return db.execute('SELECT chapter_id FROM catalog1 WHERE is_download = 1 LIMIT 1;').fetchone()[0]  # noqa: E501
+    finally:
+        db.close()
+
+
+def load_history(path: str):
+    records = []
+    if exists(path):
+        with open(path, 'r', encoding='UTF-8') as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+
+def run_step(d: str, paths, args, run: int, name: str):
+    # Every run has its own config file, so options saved by one step are
+    # not used by the next. The database and the image cache are shared
+    # unless the step is in FRESH_STEPS.
+    cwmdb, booksnew, key = paths
+    db = join(d, 'cwm.db')
+    img_cache = join(d, 'img_cache')
+    if name in FRESH_STEPS:
+        db = join(d, f'{name}-{run}.db')
+        img_cache = join(d, f'{name}-{run}')
+    work = join(d, f'{name}-{run}')
+    # EPUB files are not written if the directory does not exist.
+    makedirs(join(work, 'exported'), exist_ok=True)
+    config = join(work, 'config.json')
+    with open(config, 'w', encoding='UTF-8') as f:
+        json.dump({'img_cache_dir': img_cache}, f)
+    # Skip warnings of duplicate names in EPUB files.
+    cmd = [sys.executable, '-W', 'ignore::UserWarning', MAIN, '-c', config,
+           '-d', db, '-k', key, '--cwmdb', cwmdb, '-b', booksnew] + args
+    start = perf_counter()
+    subprocess.run(cmd, cwd=work, stdout=subprocess.DEVNULL, check=True)
+    return perf_counter() - start
+
+
+def main(args=None):
+    parser = ArgumentParser(description='Benchmark exporting synthetic libraries.')  # noqa: E501
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--history', default='e2e_history.jsonl', help='JSON lines file the results are appended to. Default: e2e_history.jsonl')  # noqa: E501
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-z', '--zip', action='store_true', help='Read booksnew and Y2hlcy8 from zip files.')  # noqa: E501
+    parser.add_argument('-S', '--step', action='append', choices=[s[0] for s in STEPS], metavar='STEP', help=f'Step to run. Can be given several times. Default: {" ".join(s[0] for s in STEPS)}')  # noqa: E501
+    parser.add_argument('sizes', nargs='*', metavar='SIZE', help=f'BOOKSxCHAPTERS. Default: {" ".join(DEFAULT_SIZES)}')  # noqa: E501
+    arg = parser.parse_args(args)
+    history = load_history(arg.history)
+    record = {
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': get_commit(), 'python': platform.python_version(),
+        'platform': platform.platform(), 'repeat': arg.repeat,
+        'seed': arg.seed, 'zip': arg.zip, 'results': {}}
+    steps = [s for s in STEPS if arg.step is None or s[0] in arg.step]
+    with ImageServer() as server, TemporaryDirectory() as tmp:
+        for size in arg.sizes or DEFAULT_SIZES:
+            books, chapters = parse_size(size)
+            d = join(tmp, size)
+            paths = generate(join(d, 'fixture'), books, chapters, arg.seed,
+                             server.base_url, use_zip=arg.zip)
+            # Import keys and fill the image cache used by the export steps.
+            run_step(d, paths, ['ik'], 0, 'setup')
+            run_step(d, paths, ['wic'], 0, 'setup')
+            chapter_id = get_downloaded_chapter(paths[0])
+            results = record['results'][size] = {}
+            for name, step_args in steps:
+                step_args = [chapter_id if a == '<chapter_id>' else a
+                             for a in step_args]
+                times = [run_step(d, paths, step_args, i, name)
+                         for i in range(arg.repeat)]
+                results[name] = {'median': median(times), 'min': min(times)}
+                line = f'{size} {name}: median {median(times) * 1000:.0f}ms, min {min(times) * 1000:.0f}ms'  # noqa: E501
+                for old in reversed(history):
+                    prev = old['results'].get(size, {}).get(name)
+                    if prev is not None:
+                        change = median(times) / prev['median'] - 1
+                        line += f' ({change:+.1%} vs {old["commit"]})'
+                        break
+                print(line)
+    with open(arg.history, 'a', encoding='UTF-8') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
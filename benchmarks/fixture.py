@@ -0,0 +1,218 @@
+# Generate a synthetic library which can be exported without a phone: a
+# NovelCiwei database, encrypted chapters in booksnew, the Y2hlcy8 keys and
+# a local server for covers and images.
+# Usage: python -m benchmarks.fixture [-s SEED] [-z] OUTPUT BOOKS CHAPTERS
+#        python -m benchmarks.fixture serve [-p PORT]
+from argparse import ArgumentParser
+from base64 import b64encode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import makedirs, remove
+from os.path import exists, join
+from random import Random
+from threading import Thread
+from zipfile import ZIP_DEFLATED, ZipFile
+import json
+import sqlite3
+import struct
+import zlib
+from crypto import encrypt
+
+
+NOVELCIWEI_TABLES = '''CREATE TABLE catalog1 (book_id TEXT, chapter_id TEXT, division_id TEXT, chapter_index INTEGER, chapter_title TEXT, is_download INTEGER);
+CREATE TABLE division (book_id TEXT, division_id TEXT, division_index INTEGER, division_name TEXT, description TEXT);
+CREATE TABLE shelf_book_info (book_id TEXT, shelf_id TEXT, book_info TEXT);
+CREATE TABLE read_history (book_id TEXT, book_info TEXT, readtime INTEGER);'''  # noqa: E501
+FIRST_BOOK_ID = 100000
+FIRST_CHAPTER_ID = 100000000
+USER_ID = 1234
+# Another account which read some chapters before, so their chapters have
+# a wrong key too.
+OTHER_USER_ID = 5678
+DEFAULT_BASE_URL = 'http://127.0.0.1:8765'
+
+
+def random_key(r: Random):
+    return ''.join(r.choice('0123456789abcdef') for _ in range(32))
+
+
+def random_text(r: Random, size: int):
+    return ''.join(chr(r.randint(0x4e00, 0x9fa5)) for _ in range(size))
+
+
+def random_chapter(r: Random, base_url: str, images: float):
+    lines = []
+    for _ in range(r.randint(20, 60)):
+        line = '　　' + random_text(r, r.randint(10, 120))
+        if r.random() < 0.05:
+            line += r.choice(['&amp;', '&lt;', '&gt;', '&nbsp;'])
+        lines.append(line)
+        if r.random() < images:
+            lines.append(f'<img src="{base_url}/img/{r.randint(0, 99)}.png" alt="插图">')  # noqa: E501
+        if r.random() < 0.05:
+            lines.append('')
+    return '\n'.join(lines)
+
+
+def generate(out: str, books: int, chapters: int, seed: int = 0,
+             base_url: str = DEFAULT_BASE_URL, images: float = 0.02,
+             use_zip: bool = False):
+    # Each book has about chapters chapters in several divisions. 10% of
+    # chapters are not downloaded. Return the paths of novelCiwei, booksnew
+    # and Y2hlcy8.
+    r = Random(seed)
+    makedirs(out, exist_ok=True)
+    cwmdb = join(out, 'novelCiwei')
+    # A fixture generated before is replaced.
+    if exists(cwmdb):
+        remove(cwmdb)
+    db = sqlite3.connect(cwmdb)
+    db.executescript(NOVELCIWEI_TABLES)
+    keys = {}
+    contents = {}
+    chapter_id = FIRST_CHAPTER_ID
+    for b in range(books):
+        book_id = FIRST_BOOK_ID + b
+        name = random_text(r, r.randint(2, 8))
+        author = random_text(r, r.randint(2, 4))
+        divisions = max(1, chapters // r.randint(20, 50))
+        count = 0
+        chapter_title = ''
+        for d in range(divisions):
+            division_id = book_id * 100 + d
+            description = random_text(r, 50) if r.random() < 0.3 else ''
+            db.execute('INSERT INTO division VALUES (?, ?, ?, ?, ?);', [
+                str(book_id), str(division_id), d + 1,
+                random_text(r, r.randint(2, 6)), description])
+            n = chapters // divisions
+            if d == divisions - 1:
+                n = chapters - count
+            for _ in range(n):
+                chapter_id += 1
+                count += 1
+                chapter_title = random_text(r, r.randint(2, 10))
+                is_download = 1 if r.random() < 0.9 else 0
+                db.execute('INSERT INTO catalog1 VALUES (?, ?, ?, ?, ?, ?);', [  # noqa: E501
+                    str(book_id), str(chapter_id), str(division_id), count,
+                    chapter_title, is_download])
+                if not is_download:
+                    continue
+                key = random_key(r)
+                keys[f'{chapter_id:09}{USER_ID}'] = key
+                if r.random() < 0.05:
+                    keys[f'{chapter_id:09}{OTHER_USER_ID}'] = random_key(r)
+                text = random_chapter(r, base_url, images)
+                contents[f'{book_id}/{chapter_id}.txt'] = encrypt(text, key)
+        info = {
+            'book_id': str(book_id), 'book_name': name,
+            'author_name': author, 'cover': f'{base_url}/cover/{b}.png',
+            'uptime': f'2024-01-{b % 28 + 1:02} 12:00:00',
+            'last_chapter_info': {'chapter_title': chapter_title}}
+        db.execute('INSERT INTO shelf_book_info VALUES (?, ?, ?);', [
+            str(book_id), str(b % 3), json.dumps(info, ensure_ascii=False)])
+        if r.random() < 0.5:
+            db.execute('INSERT INTO read_history VALUES (?, ?, ?);', [
+                str(book_id), json.dumps(info, ensure_ascii=False),
+                1700000000 + b])
+    db.commit()
+    db.close()
+    keys = {b64encode(k.encode()).decode(): v for k, v in keys.items()}
+    if use_zip:
+        booksnew = join(out, 'booksnew.zip')
+        with ZipFile(booksnew, 'w', ZIP_DEFLATED) as z:
+            for name, data in contents.items():
+                z.writestr(f'booksnew/{name}', data)
+        key = join(out, 'Y2hlcy8.zip')
+        with ZipFile(key, 'w', ZIP_DEFLATED) as z:
+            for name, data in keys.items():
+                z.writestr(name, data)
+    else:
+        booksnew = join(out, 'booksnew')
+        for name, data in contents.items():
+            path = join(booksnew, name)
+            makedirs(join(booksnew, name.split('/')[0]), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        key = join(out, 'Y2hlcy8')
+        makedirs(key, exist_ok=True)
+        for name, data in keys.items():
+            with open(join(key, name), 'w', encoding='UTF-8') as f:
+                f.write(data)
+    return cwmdb, booksnew, key
+
+
+def make_png(seed: int, size: int = 64):
+    # A small RGB PNG whose content depends on seed.
+    raw = b''.join(b'\0' + bytes((seed * 37 + x * 11 + y) % 256
+                                 for x in range(size * 3))
+                   for y in range(size))
+
+    def chunk(typ: bytes, data: bytes):
+        return struct.pack('>I', len(data)) + typ + data + \
+            struct.pack('>I', zlib.crc32(typ + data))
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b'')
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = make_png(sum(self.path.encode()))
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageServer:
+    # Serve images in a background thread. port 0 picks a free port.
+    def __init__(self, port: int = 0):
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), ImageHandler)
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main(args=None):
+    parser = ArgumentParser(description='Generate a synthetic library.')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-u', '--base-url', default=DEFAULT_BASE_URL, help='URL of the image server.')  # noqa: E501
+    parser.add_argument('-i', '--images', type=float, default=0.02, help='Chance of an image after each paragraph.')  # noqa: E501
+    parser.add_argument('-z', '--zip', action='store_true', help='Write booksnew and Y2hlcy8 as zip files.')  # noqa: E501
+    parser.add_argument('-p', '--port', type=int, default=8765, help='Port of serve.')  # noqa: E501
+    parser.add_argument('output', help='Output directory, or serve to run the image server.')  # noqa: E501
+    parser.add_argument('books', type=int, nargs='?', default=10)
+    parser.add_argument('chapters', type=int, nargs='?', default=100)
+    arg = parser.parse_args(args)
+    if arg.output == 'serve':
+        server = ImageServer(arg.port)
+        print(f'Serving images at {server.base_url}')
+        try:
+            server._thread.join()
+        except KeyboardInterrupt:
+            server.close()
+        return
+    paths = generate(arg.output, arg.books, arg.chapters, arg.seed,
+                     arg.base_url, arg.images, arg.zip)
+    print('--cwmdb {} -b {} -k {}'.format(*paths))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Measure the startup time of each action of main.py against empty
+# inputs, and list the heavy modules each action imports.
+# Usage: python -m benchmarks.startup_bench [-r REPEAT] [ACTION ...]
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+from os import makedirs
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import sqlite3
+import subprocess
+import sys
+from benchmarks.fixture import NOVELCIWEI_TABLES
+
+
+MAIN = join(dirname(dirname(abspath(__file__))), 'main.py')
+ACTIONS = {
+    'mal': ['mal', '-D', '1', '-l', 'true'],
+    'ik': ['ik'],
+    'ea-txt': ['ea', '-t', 'txt'],
+    'ea-epub': ['ea', '-t', 'epub'],
+    'wic': ['wic'],
+}
+# Modules which should only be imported by actions which need them.
+HEAVY_MODULES = ['Crypto', 'ebooklib', 'filetype', 'lxml', 'magic',
+                 'requests']
+
+
+def prepare(d: str):
+    makedirs(join(d, 'Y2hlcy8'))
+    makedirs(join(d, 'booksnew'))
+    db = sqlite3.connect(join(d, 'novelCiwei'))
+    db.executescript(NOVELCIWEI_TABLES)
+    db.close()
+
+
+def get_command(d: str, action, importtime=False):
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ['-X', 'importtime']
+    return cmd + [MAIN, '-c', join(d, 'config.json'), '-d', join(d, 'cwm.db'),
+                  '-k', join(d, 'Y2hlcy8'), '--cwmdb', join(d, 'novelCiwei'),
+                  '-b', join(d, 'booksnew')] + ACTIONS[action]
+
+
+def get_heavy_modules(d: str, action):
+    p = subprocess.run(get_command(d, action, True), cwd=d,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       text=True, check=True)
+    modules = set()
+    for line in p.stderr.splitlines():
+        name = line.rpartition('|')[2].strip()
+        if name in HEAVY_MODULES:
+            modules.add(name)
+    return sorted(modules)
+
+
+def main(args=None):
+    parser = ArgumentParser(description='Benchmark startup time of actions.')
+    parser.add_argument('-r', '--repeat', type=int, default=10)
+    parser.add_argument('actions', nargs='*', choices=[[]] + list(ACTIONS),
+                        metavar='ACTION', help=f'Default: {" ".join(ACTIONS)}')  # noqa: E501
+    arg = parser.parse_args(args)
+    with TemporaryDirectory() as d:
+        prepare(d)
+        for action in arg.actions or ACTIONS:
+            cmd = get_command(d, action)
+            # The first run creates config.json and the databases.
+            subprocess.run(cmd, cwd=d, stdout=subprocess.DEVNULL, check=True)
+            times = []
+            for _ in range(arg.repeat):
+                start = perf_counter()
+                subprocess.run(cmd, cwd=d, stdout=subprocess.DEVNULL,
+                               check=True)
+                times.append(perf_counter() - start)
+            modules = ', '.join(get_heavy_modules(d, action)) or '-'
+            print(f'{action}: median {median(times) * 1000:.0f}ms, min {min(times) * 1000:.0f}ms, heavy modules: {modules}')  # noqa: E501
+
+
+if __name__ == '__main__':
+    main()
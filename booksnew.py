@@ -1,5 +1,9 @@
+from os import stat
 from os.path import isdir, join
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
 
 
 class BooksNew:
@@ -8,22 +12,99 @@ class BooksNew:
         self._is_zip = False
         self._contain_dir_name = False
         if not isdir(path):
-            self._z = ZipFile(path)
             self._is_zip = True
-            try:
-                self._z.getinfo("booksnew/")
-                self._contain_dir_name = True
-            except KeyError:
-                pass
+            # Idle ZipFile handles. A ZipFile can not be read by several
+            # threads at the same time, so each reader takes its own one.
+            self._handles: List[ZipFile] = []
+            self._lock = Lock()
+            self._index: Dict[Tuple[int, int], ZipInfo] = {}
+            with self._zip() as z:
+                for info in z.infolist():
+                    if info.filename == 'booksnew/':
+                        self._contain_dir_name = True
+                    self.__add_index(info)
 
-    def get_chapter(self, book_id: int, chapter_id: int):
-        if self._is_zip:
+    def __add_index(self, info: ZipInfo):
+        name = info.filename
+        if name.startswith('booksnew/'):
+            name = name[9:]
+        parts = name.split('/')
+        if len(parts) != 2 or not parts[1].endswith('.txt'):
+            return
+        try:
+            key = (int(parts[0]), int(parts[1][:-4]))
+        except ValueError:
+            return
+        self._index[key] = info
+
+    @contextmanager
+    def _zip(self):
+        with self._lock:
+            z = self._handles.pop() if self._handles else None
+        if z is None:
+            z = ZipFile(self._path)
+        try:
+            yield z
+        finally:
+            with self._lock:
+                self._handles.append(z)
+
+    def __get_info(self, book_id: int, chapter_id: int) -> ZipInfo:
+        info = self._index.get((int(book_id), int(chapter_id)))
+        if info is None:
             if self._contain_dir_name:
                 path = f'booksnew/{book_id}/{chapter_id}.txt'
             else:
                 path = f'{book_id}/{chapter_id}.txt'
-            return self._z.read(path).decode()
+            raise KeyError(f'There is no item named {path!r} in the archive')  # noqa: E501
+        return info
+
+    def close(self):
+        if self._is_zip:
+            with self._lock:
+                for z in self._handles:
+                    z.close()
+                self._handles = []
+
+    def get_chapter(self, book_id: int, chapter_id: int):
+        if self._is_zip:
+            info = self.__get_info(book_id, chapter_id)
+            with self._zip() as z:
+                return z.read(info).decode()
         else:
             with open(join(self._path, str(book_id), f"{chapter_id}.txt"), 'r',
                       encoding='UTF-8') as f:
                 return f.read()
+
+    def get_stamps(self, book_id: int, chapter_ids: List[int]
+                   ) -> Dict[int, Optional[list]]:
+        # [size, stamp] of the encrypted chapters, without reading them.
+        # stamp is mtime in nanoseconds for a directory and CRC32 for a zip
+        # file. None if the chapter is missing.
+        stamps = {}
+        for i in chapter_ids:
+            i = int(i)
+            if self._is_zip:
+                info = self._index.get((int(book_id), i))
+                stamps[i] = None if info is None else [info.file_size,
+                                                       info.CRC]
+                continue
+            try:
+                st = stat(join(self._path, str(book_id), f'{i}.txt'))
+                stamps[i] = [st.st_size, st.st_mtime_ns]
+            except OSError:
+                stamps[i] = None
+        return stamps
+
+    def get_chapters(self, book_id: int, chapter_ids: List[int]) -> List[str]:
+        # Return contents in the order of chapter_ids. Entries of a zip file
+        # are read in the order they are stored in the archive.
+        if not self._is_zip:
+            return [self.get_chapter(book_id, i) for i in chapter_ids]
+        infos = [self.__get_info(book_id, i) for i in chapter_ids]
+        order = sorted(range(len(infos)), key=lambda i: infos[i].header_offset)
+        contents = [None] * len(infos)
+        with self._zip() as z:
+            for i in order:
+                contents[i] = z.read(infos[i]).decode()
+        return contents
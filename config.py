@@ -60,10 +60,18 @@ class Config:
     def chapter_id(self):
         return getattr(self._args, 'cid', None)
 
+    @cached_property
+    def compress_level(self):
+        return self.get_arg('compress_level', None)
+
     @cached_property
     def cwmdb(self):
         return self.get_arg('cwmdb', None)
 
+    @cached_property
+    def cwmdb_snapshot(self):
+        return self.get_arg('cwmdb_snapshot', None)
+
     @cached_property
     def db(self):
         return self.get_arg('db', 'cwm.db')
@@ -72,6 +80,10 @@ class Config:
     def division_id(self):
         return getattr(self._args, 'division_id', None)
 
+    @cached_property
+    def download_threads(self):
+        return self.get_arg('download_threads', 8)
+
     @cached_property
     def export_book_template(self):
         return self.get_arg('export_book_template', 'exported/<book_name> - <author_name>.<ext>')  # noqa: E501
@@ -84,10 +96,18 @@ class Config:
     def export_epub(self):
         return self.export_type.find('epub') >= 0
 
+    @cached_property
+    def export_jsonl(self):
+        return self.export_type.find('jsonl') >= 0
+
     @cached_property
     def export_nodownload(self):
         return self.get_arg('export_nodownload', True)
 
+    @cached_property
+    def export_sqlite(self):
+        return self.export_type.find('sqlite') >= 0
+
     @cached_property
     def export_txt(self):
         return self.export_type.find('txt') >= 0
@@ -113,14 +133,37 @@ class Config:
             temp = temp.replace(f'<{k}>', str(chapter[k]))
         return temp
 
+    @cached_property
+    def host_connections(self):
+        return self.get_arg('host_connections', 4)
+
     @cached_property
     def img_cache_dir(self):
         return self.get_arg('img_cache_dir', 'img_cache')
 
+    @cached_property
+    def image_cache_size(self):
+        # Maximum size of the image cache in bytes. 0 means unlimited.
+        return self.get_arg('image_cache_size', 0)
+
     @cached_property
     def image_type(self):
         return self.get_arg('image_type', 'inline')
 
+    @cached_property
+    def incremental(self):
+        # Only for this run, so it is not saved.
+        x = getattr(self._args, 'incremental', None)
+        return True if x is None else x
+
+    @cached_property
+    def jobs(self):
+        return self.get_arg('jobs', 1)
+
+    @cached_property
+    def jsonl_output(self):
+        return self.get_arg('jsonl_output', '-')
+
     @cached_property
     def key(self):
         return self.get_arg('key', None)
@@ -133,10 +176,71 @@ class Config:
     def page_size(self):
         return self.get_arg('page_size', 10)
 
+    @cached_property
+    def profile(self):
+        return getattr(self._args, 'profile', None)
+
+    @cached_property
+    def progress(self):
+        return self.get_arg('progress', False)
+
+    @cached_property
+    def progress_log(self):
+        return getattr(self._args, 'progress_log', None)
+
+    @cached_property
+    def query(self):
+        return getattr(self._args, 'query', None)
+
     @cached_property
     def save_to_config(self):
         return getattr(self._data, 'save_to_config', True)
 
+    @cached_property
+    def search_db(self):
+        return self.get_arg('search_db', 'exported/search.db')
+
+    @cached_property
+    def search_limit(self):
+        return self.get_arg('search_limit', 20)
+
+    @cached_property
+    def streaming_epub(self):
+        return self.get_arg('streaming_epub', False)
+
+    @cached_property
+    def threads(self):
+        return self.get_arg('threads', 4)
+
+    @cached_property
+    def transcode_jobs(self):
+        return self.get_arg('transcode_jobs', 4)
+
+    @cached_property
+    def txt_ext(self):
+        # Extension of exported TXT books. txt.gz, txt.xz and txt.zst are
+        # compressed. Export types are checked by main.
+        for t in self.export_type.split(','):
+            t = t.strip()
+            if t.startswith('txt'):
+                return t
+        return 'txt'
+
+    @cached_property
+    def vault(self):
+        # Path to the database of decrypted chapters. None or an empty
+        # string disables it.
+        return self.get_arg('vault', None)
+
+    @cached_property
+    def watch_delay(self):
+        # Seconds without new files before changes are exported.
+        return self.get_arg('watch_delay', 2)
+
+    @cached_property
+    def watch_interval(self):
+        return self.get_arg('watch_interval', 10)
+
     def save(self):
         with open(self._path, 'w', encoding='UTF-8') as f:
             json.dump(self._data, f, ensure_ascii=False)
@@ -1,14 +1,78 @@
 from Crypto.Cipher import AES
 from hashlib import sha256
-from base64 import b64decode
+from base64 import b64decode, b64encode
+from binascii import Error as Base64Error
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
 
 
-def decrypt(encrypted: str | bytes,
-            key: str | bytes = 'zG2nSeEfSHfvTCHy5LCcqtBbQehKNLXn') -> bytes:
+DEFAULT_KEY = 'zG2nSeEfSHfvTCHy5LCcqtBbQehKNLXn'
+IV = b'\0' * 16
+
+
+@lru_cache(maxsize=4096)
+def derive_key(key: str | bytes) -> bytes:
     if isinstance(key, str):
         key = key.encode()
-    ekey = sha256(key).digest()
-    iv = b'\0' * 16
-    aes = AES.new(ekey, AES.MODE_CBC, iv)
+    return sha256(key).digest()
+
+
+def unpad(data: bytes) -> Optional[bytes]:
+    # Remove PKCS#7 padding. Return None if the padding is not valid.
+    if len(data) == 0 or len(data) % 16:
+        return None
+    n = data[-1]
+    if n < 1 or n > 16 or data[-n:] != bytes((n,)) * n:
+        return None
+    return data[:-n]
+
+
+def decrypt(encrypted: str | bytes,
+            key: str | bytes = DEFAULT_KEY) -> bytes:
+    aes = AES.new(derive_key(key), AES.MODE_CBC, IV)
     data = aes.decrypt(b64decode(encrypted))
-    return data[0:len(data) - ord(chr(data[len(data) - 1]))]
+    return data[0:len(data) - data[-1]]
+
+
+def encrypt(data: str | bytes, key: str | bytes = DEFAULT_KEY) -> bytes:
+    if isinstance(data, str):
+        data = data.encode()
+    n = 16 - len(data) % 16
+    aes = AES.new(derive_key(key), AES.MODE_CBC, IV)
+    return b64encode(aes.encrypt(data + bytes((n,)) * n))
+
+
+def decrypt_with_keys(encrypted: str | bytes,
+                      keys: Iterable[str | bytes]) -> Optional[str]:
+    # Try every key and return the first text with valid padding and UTF-8.
+    # Return None if no key matches.
+    try:
+        data = b64decode(encrypted)
+    except Base64Error:
+        return None
+    if len(data) == 0 or len(data) % 16:
+        return None
+    keys = list(keys)
+    # The padding is in the last block, so a wrong key can be rejected
+    # after decrypting only one block.
+    last_iv = data[-32:-16] if len(data) > 16 else IV
+    for key in keys:
+        ekey = derive_key(key)
+        if len(keys) > 1:
+            last = AES.new(ekey, AES.MODE_CBC, last_iv).decrypt(data[-16:])
+            if unpad(last) is None:
+                continue
+        plain = unpad(AES.new(ekey, AES.MODE_CBC, IV).decrypt(data))
+        if plain is None:
+            continue
+        try:
+            return plain.decode()
+        except UnicodeDecodeError:
+            pass
+    return None
+
+
+def decrypt_batch(items: Iterable[Tuple[str | bytes, Iterable[str | bytes]]]
+                  ) -> List[Optional[str]]:
+    # items are (encrypted, keys) pairs.
+    return [decrypt_with_keys(encrypted, keys) for encrypted, keys in items]
@@ -1,6 +1,12 @@
+import json
 import sqlite3
+from os import makedirs
+from os.path import dirname
 from semver import Version
-from typing import Dict, Optional, List
+from threading import Lock
+from typing import Dict, Optional, List, Set, Tuple
+from contextlib import contextmanager
+from profiler import trace_sql
 
 
 VERSION_TABLE = '''CREATE TABLE version (
@@ -19,12 +25,38 @@ division_id INT,
 is_linear BOOL,
 PRIMARY KEY(division_id)
 );'''
+KEY_SOURCE_TABLE = '''CREATE TABLE key_source (
+source TEXT,
+name TEXT,
+size INT,
+stamp INT,
+PRIMARY KEY (source, name)
+);'''
+EXPORT_MANIFEST_TABLE = '''CREATE TABLE export_manifest (
+book_id INT,
+chapters TEXT,
+export_type TEXT,
+image_type TEXT,
+template TEXT,
+catalog TEXT,
+outputs TEXT,
+PRIMARY KEY (book_id)
+);'''
+
+# Maximum number of entries in each in-process cache of CwmDb.
+CACHE_SIZE = 100000
+# Open SharedDb of this process by (class, path)
+_shared_dbs = {}
 
 
 class CwmDb:
     def __init__(self, db_path):
         self._db = sqlite3.connect(db_path, check_same_thread=False)
-        self.version = Version(0, 0, 0, 1)
+        trace_sql(self._db, 'cwm')
+        self.version = Version(0, 0, 0, 3)
+        # chapter_id -> keys and division_id -> is_linear
+        self._key_cache: Dict[int, List[str]] = {}
+        self._mark_cache: Dict[int, bool] = {}
         if not self.__check_database():
             self.__create_table()
 
@@ -36,6 +68,10 @@ class CwmDb:
         if v < self.version:
             if v < Version(0, 0, 0, 1):
                 self._db.execute(DIVISION_TABLE)
+            if v < Version(0, 0, 0, 2):
+                self._db.execute(KEY_SOURCE_TABLE)
+            if v < Version(0, 0, 0, 3):
+                self._db.execute(EXPORT_MANIFEST_TABLE)
             self.__update_exists_tables()
             self.__write_version()
         return True
@@ -48,6 +84,10 @@ class CwmDb:
             self._db.execute(KEY_TABLE)
         if 'division' not in self._exist_tables:
             self._db.execute(DIVISION_TABLE)
+        if 'key_source' not in self._exist_tables:
+            self._db.execute(KEY_SOURCE_TABLE)
+        if 'export_manifest' not in self._exist_tables:
+            self._db.execute(EXPORT_MANIFEST_TABLE)
         self._db.commit()
 
     def __write_version(self):
@@ -76,28 +116,170 @@ class CwmDb:
     def add_key(self, chapter_id: int, user_id: int, key: str):
         self._db.execute('INSERT OR REPLACE INTO key VALUES (?, ?, ?);', [
                          chapter_id, user_id, key])
+        self._key_cache.pop(int(chapter_id), None)
+
+    def add_keys(self, keys: List[Tuple[int, int, str]]):
+        self._db.executemany('INSERT OR REPLACE INTO key VALUES (?, ?, ?);',
+                             keys)
+        if keys:
+            self._key_cache.clear()
+
+    def get_all_key_ids(self) -> Set[Tuple[int, int]]:
+        cur = self._db.execute('SELECT chapter_id, user_id FROM key;')
+        return set(cur)
+
+    def get_key_with_user(self, chapter_id: int, user_id: int
+                          ) -> Optional[str]:
+        cur = self._db.execute(
+            'SELECT key FROM key WHERE chapter_id = ? AND user_id = ?;',
+            [chapter_id, user_id])
+        for i in cur:
+            return i[0]
 
-    def get_all_keys_as_origin(self) -> Dict[str, str]:
-        cur = self._db.execute('SELECT chapter_id, user_id, key FROM key;')
-        return {f'{i[0]}{i[1]}': i[2] for i in cur}
+    @contextmanager
+    def bulk(self):
+        # Faster settings for importing many rows in one transaction.
+        self._db.commit()
+        try:
+            self._db.execute('PRAGMA journal_mode = WAL;')
+        except sqlite3.OperationalError:
+            # Other connections are using the database.
+            pass
+        synchronous = self._db.execute('PRAGMA synchronous;').fetchone()[0]
+        self._db.execute('PRAGMA synchronous = NORMAL;')
+        try:
+            yield self
+        finally:
+            self._db.commit()
+            self._db.execute(f'PRAGMA synchronous = {int(synchronous)};')
 
     def commit(self):
         self._db.commit()
 
+    def get_export_manifest(self, book_id: int) -> Optional[dict]:
+        cur = self._db.execute(
+            'SELECT chapters, export_type, image_type, template, catalog, outputs FROM export_manifest WHERE book_id = ?;',  # noqa: E501
+            [book_id])
+        for i in cur:
+            return {'chapters': json.loads(i[0]), 'export_type': i[1],
+                    'image_type': i[2], 'template': i[3], 'catalog': i[4],
+                    'outputs': json.loads(i[5])}
+
+    def set_export_manifest(self, book_id: int, manifest: dict):
+        self._db.execute(
+            'INSERT OR REPLACE INTO export_manifest VALUES (?, ?, ?, ?, ?, ?, ?);',  # noqa: E501
+            [book_id, json.dumps(manifest['chapters']),
+             manifest['export_type'], manifest['image_type'],
+             manifest['template'], manifest['catalog'],
+             json.dumps(manifest['outputs'])])
+        self._db.commit()
+
     def get_key(self, chapter_id: int) -> List[str]:
+        chapter_id = int(chapter_id)
+        if chapter_id in self._key_cache:
+            return self._key_cache[chapter_id]
         cur = self._db.execute('SELECT key FROM key WHERE chapter_id = ?;', [
                               chapter_id])
-        return [i[0] for i in cur]
+        keys = [i[0] for i in cur]
+        self._cache(self._key_cache, {chapter_id: keys})
+        return keys
 
-    def get_mark(self, division_id: int):
+    def get_keys(self, chapter_ids: List[int]) -> Dict[int, List[str]]:
+        chapter_ids = [int(i) for i in chapter_ids]
+        missing = [i for i in chapter_ids if i not in self._key_cache]
+        keys = {i: [] for i in missing}
+        if missing:
+            cur = self._db.execute(
+                'SELECT chapter_id, key FROM key WHERE chapter_id IN (SELECT value FROM json_each(?));',  # noqa: E501
+                [json.dumps(missing)])
+            for i in cur:
+                keys[i[0]].append(i[1])
+        for i in chapter_ids:
+            if i not in keys:
+                keys[i] = self._key_cache[i]
+        self._cache(self._key_cache, keys)
+        return keys
+
+    def get_key_sources(self, source: str) -> Dict[str, Tuple[int, int]]:
         cur = self._db.execute(
-            'SELECT is_linear FROM division WHERE division_id = ?;',
-            [division_id])
-        for i in cur:
-            return bool(i[0])
-        return True
+            'SELECT name, size, stamp FROM key_source WHERE source = ?;',
+            [source])
+        return {i[0]: (i[1], i[2]) for i in cur}
+
+    def set_key_sources(self, source: str,
+                        files: Dict[str, Tuple[int, int]]):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO key_source VALUES (?, ?, ?, ?);',
+            [(source, k, v[0], v[1]) for k, v in files.items()])
+
+    def remove_key_sources(self, source: str, names: List[str]):
+        self._db.executemany(
+            'DELETE FROM key_source WHERE source = ? AND name = ?;',
+            [(source, name) for name in names])
+
+    def get_mark(self, division_id: int):
+        return self.get_marks([division_id])[int(division_id)]
+
+    def get_marks(self, division_ids: List[int]) -> Dict[int, bool]:
+        division_ids = [int(i) for i in division_ids]
+        missing = [i for i in division_ids if i not in self._mark_cache]
+        marks = {i: True for i in missing}
+        if missing:
+            cur = self._db.execute(
+                'SELECT division_id, is_linear FROM division WHERE division_id IN (SELECT value FROM json_each(?));',  # noqa: E501
+                [json.dumps(missing)])
+            for i in cur:
+                marks[i[0]] = bool(i[1])
+        for i in division_ids:
+            if i not in marks:
+                marks[i] = self._mark_cache[i]
+        self._cache(self._mark_cache, marks)
+        return marks
 
     def set_mark(self, division_id: int, is_linear: bool):
         self._db.execute('INSERT OR REPLACE INTO division VALUES (?, ?);', [
                          division_id, is_linear])
         self._db.commit()
+        self._mark_cache[int(division_id)] = bool(is_linear)
+
+    def _cache(self, cache: dict, values: dict):
+        # Keep the caches bounded during long exports.
+        if len(cache) + len(values) > CACHE_SIZE:
+            cache.clear()
+        cache.update(values)
+
+
+class SharedDb:
+    # A database created next to the exported files, used by the threads of
+    # an export through one connection. Processes of export all open their
+    # own connections to the same file, so WAL is used and writers wait for
+    # each other.
+    def __init__(self, path: str, name: str, tables: List[str]):
+        d = dirname(path)
+        if d:
+            makedirs(d, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        trace_sql(self._db, name)
+        self._db.execute('PRAGMA journal_mode = WAL;')
+        self._lock = Lock()
+        with self._lock:
+            for sql in tables:
+                self._db.execute(sql)
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def get_shared_db(cls, path: str):
+    # The instance of cls for path in this process.
+    key = (cls, path)
+    if key not in _shared_dbs:
+        _shared_dbs[key] = cls(path)
+    return _shared_dbs[key]
+
+
+def reset_shared_dbs():
+    # Called in a new worker process, whose inherited connections must not
+    # be used.
+    _shared_dbs.clear()
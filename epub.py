@@ -1,28 +1,27 @@
 from ebooklib import epub, ITEM_IMAGE
 from lxml import etree
-import subprocess
 from typing import Optional
 import os
 from config import Config
-from image_cache import get_cache
+from image_cache import can_guess_mime, get_image
+from transcode import submit_convert
+from profiler import stage
 from traceback import print_exc
 import xml.etree.ElementTree as ET
 from html.parser import HTMLParser
-try:
-    import magic
-    have_magic = True
-    have_filetype = False
-except ImportError:
-    have_magic = False
-    try:
-        import filetype
-        have_filetype = True
-    except ImportError:
-        have_filetype = False
-        print('Warning: python-magic or filetype not found. The mimetype in EPUB file may wrong.')  # noqa: E501
-        import platform
-        if platform.system() == "Windows":
-            print('python-magic-bin is also needed on Windows if you use magic.')  # noqa: E501
+from html import escape, unescape
+from ebooklib.utils import get_pages
+import shutil
+import re
+import struct
+import zipfile
+
+
+# Manifest ids of a chapter: ch<id>, ch<id>_img and i<id>_<n>[f]
+CHAPTER_ITEM_ID = re.compile(r'^(?:ch(\d+)(?:_img)?|i(\d+)_\d+f?)$')
+# A line of text whose only tags are well-formed img tags
+IMG_LINE = re.compile(r'''(?:[^<]|<img(?:\s+[^\s"'<>=/]+(?:\s*=\s*(?:"[^"<>]*"|'[^'<>]*'|[^\s"'<>=`]+))?)*\s*/?>)*''', re.I)  # noqa: E501
+COPY_BUFFER_SIZE = 1 << 20
 
 
 # Add fallback property to ebooklib
@@ -57,6 +56,130 @@ class EpubPathImage(EpubImage):
         return default
 
 
+# Items copied from an existing EPUB file without decompressing them.
+class EpubRawItem(EpubItem):
+    def __init__(self, uid, file_name, media_type, raw):
+        super().__init__(uid, file_name, media_type)
+        # (ZipFile, ZipInfo) of the source entry
+        self.raw = raw
+
+
+class EpubRawHtml(epub.EpubHtml):
+    def __init__(self, uid, file_name, title, raw, page_anchors):
+        super().__init__(uid, file_name, title=title, lang='zh-CN')
+        self.raw = raw
+        # (id, text) of elements listed in the page list of nav.xhtml
+        self.page_anchors = page_anchors
+
+    def get_body_content(self):
+        # Only used by ebooklib to build the page list.
+        return get_page_body(self.page_anchors).encode()
+
+
+def get_page_body(page_anchors) -> str:
+    # A body which only contains the pages of page_anchors. get_pages
+    # returns the same pages for it as for the original document.
+    body = ''.join(
+        f'<span epub:type="pagebreak" id="{escape(i)}">{escape(t)}</span>'
+        for i, t in page_anchors)
+    return f'<div>{body}</div>'
+
+
+def copy_zip_entry(out: zipfile.ZipFile, src: zipfile.ZipFile,
+                   info: zipfile.ZipInfo, arcname: str):
+    # Copy the compressed data of info from src to out as arcname.
+    src.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           src.fp.read(zipfile.sizeFileHeader))
+    # File name length and extra field length
+    src.fp.seek(header[10] + header[11], os.SEEK_CUR)
+    zinfo = zipfile.ZipInfo(arcname, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.flag_bits = info.flag_bits & ~0x08  # No data descriptor
+    zinfo.external_attr = info.external_attr
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    zip64 = max(info.compress_size, info.file_size) > zipfile.ZIP64_LIMIT
+    with out._lock:
+        out.fp.seek(out.start_dir)
+        zinfo.header_offset = out.fp.tell()
+        out._writecheck(zinfo)
+        out._didModify = True
+        out.fp.write(zinfo.FileHeader(zip64))
+        remain = info.compress_size
+        while remain > 0:
+            data = src.fp.read(min(remain, COPY_BUFFER_SIZE))
+            if not data:
+                raise EOFError(f'Unexpected end of {info.filename}.')
+            out.fp.write(data)
+            remain -= len(data)
+        out.filelist.append(zinfo)
+        out.NameToInfo[zinfo.filename] = zinfo
+        out.start_dir = out.fp.tell()
+
+
+class ExistingEpub:
+    # Reads the manifest, TOC titles and page list of an EPUB file written
+    # by EpubFile, so its chapters can be copied into a new file.
+    def __init__(self, path: str):
+        self.zip = zipfile.ZipFile(path)
+        try:
+            self.__load()
+        except Exception:
+            self.zip.close()
+            raise
+
+    def __load(self):
+        ns = {'opf': 'http://www.idpf.org/2007/opf',
+              'ncx': 'http://www.daisy.org/z3986/2005/ncx/',
+              'xhtml': 'http://www.w3.org/1999/xhtml',
+              'epub': 'http://www.idpf.org/2007/ops',
+              'c': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+        container = etree.fromstring(self.zip.read('META-INF/container.xml'))
+        rootfile = container.find('c:rootfiles/c:rootfile', ns)
+        self.folder, _, opf_name = rootfile.get('full-path').rpartition('/')
+        folder = self.folder
+        # id -> (href, media type, fallback)
+        self.items = {}
+        # chapter id -> manifest ids of the chapter in manifest order
+        self.chapters = {}
+        opf = etree.fromstring(self.zip.read(f'{folder}/{opf_name}'))
+        for item in opf.iterfind('opf:manifest/opf:item', ns):
+            uid = item.get('id')
+            self.items[uid] = (item.get('href'), item.get('media-type'),
+                               item.get('fallback'))
+            m = CHAPTER_ITEM_ID.match(uid)
+            if m:
+                chapter_id = m.group(1) or m.group(2)
+                self.chapters.setdefault(chapter_id, []).append(uid)
+        # navPoint id -> title
+        self.titles = {}
+        ncx = etree.fromstring(self.zip.read(f'{folder}/toc.ncx'))
+        for point in ncx.iterfind('.//ncx:navPoint', ns):
+            text = point.find('ncx:navLabel/ncx:text', ns)
+            if text is not None:
+                self.titles[point.get('id')] = text.text or ''
+        # href -> [(id, text)] of the page list
+        self.pages = {}
+        nav = etree.fromstring(self.zip.read(f'{folder}/nav.xhtml'))
+        for n in nav.iterfind('.//xhtml:nav', ns):
+            if n.get(f'{{{ns["epub"]}}}type') != 'page-list':
+                continue
+            for a in n.iterfind('.//xhtml:a', ns):
+                href, _, anchor = a.get('href').partition('#')
+                self.pages.setdefault(href, []).append((anchor, a.text))
+
+    def get_info(self, href: str) -> Optional[zipfile.ZipInfo]:
+        try:
+            return self.zip.getinfo(f'{self.folder}/{href}')
+        except KeyError:
+            return None
+
+    def close(self):
+        self.zip.close()
+
+
 class EpubWriter(epub.EpubWriter):
     def _write_opf_manifest(self, root):
         manifest = epub.etree.SubElement(root, 'manifest')
@@ -103,39 +226,72 @@ class EpubWriter(epub.EpubWriter):
 
         return _ncx_id
 
+    def _write_item(self, item):
+        folder = self.book.FOLDER_NAME
+        if getattr(item, 'raw', None) is not None:
+            copy_zip_entry(self.out, item.raw[0], item.raw[1],
+                           f'{folder}/{item.file_name}')
+        elif isinstance(item, EpubPathImage) and item.path:
+            # Copy images in chunks instead of reading them into memory.
+            with open(item.path, 'rb') as src, \
+                    self.out.open(f'{folder}/{item.file_name}', 'w') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+        elif isinstance(item, epub.EpubNcx):
+            self.out.writestr(f'{folder}/{item.file_name}', self._get_ncx())
+        elif isinstance(item, epub.EpubNav):
+            self.out.writestr(f'{folder}/{item.file_name}',
+                              self._get_nav(item))
+        elif item.manifest:
+            self.out.writestr(f'{folder}/{item.file_name}',
+                              item.get_content())
+        else:
+            self.out.writestr(item.file_name, item.get_content())
 
-have_ffmpeg = None
-
-
-def check_ffmpeg():
-    p = subprocess.Popen(['ffmpeg', '-h'], stdout=subprocess.DEVNULL,
-                         stderr=subprocess.DEVNULL)
-    p.communicate()
-    global have_ffmpeg
-    have_ffmpeg = not p.wait()
-    if not have_ffmpeg:
-        print('Warning: Can not find ffmpeg. Some epub readers may failed to open these pictures.')  # noqa: E501
-
-
-def perform_convert(image_path: str) -> Optional[str]:
-    output_path = os.path.splitext(image_path)[0] + '_fallback.jpg'
-    if os.path.exists(output_path) and os.path.getsize(output_path) > 4096:
-        return output_path
-    if have_ffmpeg is None:
-        check_ffmpeg()
-    if have_ffmpeg:
-        p = subprocess.Popen(['ffmpeg', '-y', '-i', image_path, output_path],
-                             stdout=subprocess.DEVNULL,
-                             stderr=subprocess.DEVNULL)
-        p.communicate()
-        code = p.wait()
-        if not code:
-            return output_path
+    def _write_items(self):
+        for item in self.book.get_items():
+            if not getattr(item, 'written', False):
+                self._write_item(item)
+
+
+class EpubStreamWriter(EpubWriter):
+    # Writes items into the zip file as soon as they are added to the book.
+    # Contents of written items are dropped, only metadata needed by the
+    # manifest, spine, TOC and page list is kept in memory.
+    def __init__(self, name, book, options=None):
+        super().__init__(name, book, options)
+        self.out = zipfile.ZipFile(
+            name, 'w', zipfile.ZIP_DEFLATED,
+            compresslevel=self.options['compresslevel'])
+        self.out.writestr('mimetype', 'application/epub+zip',
+                          compress_type=zipfile.ZIP_STORED)
+        self._write_container()
+
+    def write_item(self, item):
+        self._write_item(item)
+        item.written = True
+        if isinstance(item, epub.EpubCoverHtml):
+            # The content is generated from the template.
+            return
+        if isinstance(item, epub.EpubHtml):
+            if getattr(item, 'raw', None) is None:
+                item.content = get_page_body(
+                    [(i, t) for _, i, t in get_pages(item)])
+        elif isinstance(item, EpubPathImage):
+            item.path = None
         else:
-            print(f'Warning: Can not convert images by using ffmpeg. (Exit code: {code}) Some epub readers may failed to open these pictures.')  # noqa: E501
-            return None
-    else:
-        return None
+            item.content = b''
+
+    def write(self):
+        # Items not written yet, the OPF, NCX and navigation document are
+        # written at last.
+        try:
+            self._write_opf()
+            self._write_items()
+        finally:
+            self.out.close()
+
+    def close(self):
+        self.out.close()
 
 
 class HTMLImage:
@@ -144,6 +300,9 @@ class HTMLImage:
         self.alt = None
         self.path = None
         self.epub_path = None
+        self.image = None
+        # Future of the JPEG fallback of a WebP image
+        self.fallback = None
         for key, value in attrs:
             if key == 'src':
                 self.src = value
@@ -160,7 +319,8 @@ class HTMLImage:
         if not self.is_valid():
             return False
         try:
-            self.path = get_cache(self.cfg, self.src)
+            self.image = get_image(self.cfg, self.src)
+            self.path = self.image.path
             return True
         except Exception:
             print_exc()
@@ -170,15 +330,9 @@ class HTMLImage:
             return ""
         if not self.download_image():
             raise ValueError("Failed to download image.")
-        self.epub_path = os.path.basename(self.path)
-        if have_magic:
-            with open(self.path, 'rb') as f:
-                mime = magic.from_buffer(f.read(4096), True)
-            self.epub_path = os.path.splitext(self.epub_path)[0] + get_extension(mime)  # noqa: E501
-        if have_filetype:
-            with open(self.path, 'rb') as f:
-                mime = filetype.guess_mime(f.read(4096))
-            self.epub_path = os.path.splitext(self.epub_path)[0] + get_extension(mime)  # noqa: E501
+        self.epub_path = self.image.name
+        if can_guess_mime():
+            self.epub_path = os.path.splitext(self.epub_path)[0] + get_extension(self.image.mime)  # noqa: E501
         d = {'src': self.epub_path}
         if self.alt:
             d['alt'] = self.alt
@@ -213,6 +367,31 @@ class ContentParser(HTMLParser):
         self.footnote = ''
         self.img_index = 0
         self.chapter_id = chapter_id
+        # Rendered XHTML body, set by EpubFile.render_chapter
+        self.result = ''
+
+    def feed_text(self, content: str):
+        # Same as feeding '<p>' + '</p>\n<p>'.join(lines) + '</p>', but
+        # lines without tags are not tokenized.
+        lines = content.splitlines()
+        data = []
+        for line in lines:
+            if '<' not in line:
+                if '&' in line:
+                    line = unescape(line)
+                if line:
+                    data.append(line)
+            elif IMG_LINE.fullmatch(line):
+                parser = ContentParser(self.cfg, self.chapter_id)
+                parser.feed(f'<p>{line}</p>')
+                parser.close()
+                data.extend(parser.data)
+            else:
+                # Other tags may span several lines.
+                self.feed('<p>' + '</p>\n<p>'.join(lines) + '</p>')
+                self.close()
+                return
+        self.data = data
 
     def handle_data(self, data: str):
         if self._in_paragraph:
@@ -268,34 +447,35 @@ class ContentParser(HTMLParser):
             data_list = self.data
             default_data_list = True
             root = self
-            self.footnote = ''
-        data = ''
+            self._footnotes = []
+        data = []
         for i in data_list:
             if isinstance(i, str):
                 if default_data_list:
-                    data += f'<p>{i}</p>\n'
+                    data.append(f'<p>{i}</p>\n')
                 else:
-                    data += i
+                    data.append(i)
             elif isinstance(i, HTMLImage):
                 if i.is_valid():
                     try:
-                        data += i.to_local(root.img_index)
+                        data.append(i.to_local(root.img_index))
                         self.images.append(i)
                         if i.footnote:
-                            root.footnote += i.footnote
+                            root._footnotes.append(i.footnote)
                         root.img_index += 1
                     except ValueError:
                         print("the image is not valid.", i.src)
             elif isinstance(i, list):
-                data += f'<p>{self.to_local(i, root)}</p>\n'
+                data.append(f'<p>{self.to_local(i, root)}</p>\n')
             else:
                 raise NotImplementedError()
         if self._paragraph_data:
-            data += f'<p>{self._paragraph_data}</p>\n'
+            data.append(f'<p>{self._paragraph_data}</p>\n')
         if default_data_list:
+            self.footnote = ''.join(self._footnotes)
             if not self.cfg.add_images_to_single_page:
-                data += self.footnote
-        return data
+                data.append(self.footnote)
+        return ''.join(data)
 
 
 def get_extension(mime: str) -> str:
@@ -315,26 +495,68 @@ def get_extension(mime: str) -> str:
 
 
 class EpubFile:
-    def __init__(self, cfg: Config, out: str):
+    def __init__(self, cfg: Config, out: str, update=False):
         self.epub = epub.EpubBook()
         self.EpubList = list()
         self.epub.set_language('zh-CN')
         self.cfg = cfg
         self.out = out
+        # The existing EPUB file whose chapters can be reused in update mode
+        self.old = None
+        if update and os.path.exists(out):
+            try:
+                self.old = ExistingEpub(out)
+            except Exception:
+                print_exc()
+                print(f'Warning: Can not read {out}. Rebuilding it.')
+        # Writes items as they are added if streaming_epub is enabled
+        self.writer = None
+        # Number of items of the book which are written by self.writer
+        self.streamed = 0
+        # (image, fallback image, future) of fallbacks being converted
+        self.fallbacks = []
+
+    def __stream(self):
+        if not self.cfg.streaming_epub:
+            return
+        if self.writer is None:
+            self.writer = EpubStreamWriter(self.out + '.tmp', self.epub, {})
+        items = self.epub.items
+        while self.streamed < len(items):
+            item = items[self.streamed]
+            # Fallbacks being converted are written when saving.
+            if not getattr(item, 'converting', False):
+                with stage('epub.stream'):
+                    self.writer.write_item(item)
+            self.streamed += 1
+
+    def __resolve_fallbacks(self):
+        for img, jpg_img, future in self.fallbacks:
+            jpg_img.converting = False
+            jpg_img.path = future.result()
+            if jpg_img.path is None:
+                img.fallback = None
+                self.epub.items.remove(jpg_img)
+        self.fallbacks = []
+
+    def __add_to_toc(self, ch, division_name: str):
+        if self.last_division_name != division_name:
+            self.EpubList.append([epub.Link(ch.file_name, division_name), []])
+            self.last_division_name = division_name
+        if isinstance(self.EpubList[-1], list):
+            self.EpubList[-1][-1].append(ch)
+        else:
+            self.EpubList.append(ch)
 
     def set_book(self, book):
         self.epub.set_identifier(str(book['book_id']))
         self.epub.set_title(book['book_name'])
         self.epub.add_author(book['author_name'])
-        cover_path = get_cache(self.cfg, book['cover'])
-        with open(cover_path, 'rb') as f:
+        image = get_image(self.cfg, book['cover'])
+        with open(image.path, 'rb') as f:
             cover = f.read()
-        if have_magic:
-            mime_type = magic.from_buffer(cover, mime=True)
-            file_name = 'cover' + get_extension(mime_type)
-        elif have_filetype:
-            mime_type = filetype.guess_mime(cover)
-            file_name = 'cover' + get_extension(mime_type)
+        if can_guess_mime():
+            file_name = 'cover' + get_extension(image.mime)
         else:
             file_name = 'cover.png'
         self.epub.set_cover(file_name, cover)
@@ -348,9 +570,27 @@ class EpubFile:
         self.EpubList.append(intro)
         self.epub.spine.append(intro)
         self.last_division_name = ''
+        self.__stream()
+
+    def render_chapter(self, chapter, content: str) -> ContentParser:
+        # Thread safe. Can be called ahead of add_chapter.
+        parser = ContentParser(self.cfg, chapter['chapter_id'])
+        try:
+            with stage('render.parse'):
+                parser.feed_text(content)
+        except Exception as e:
+            print('<p>' + '</p>\n<p>'.join(content.splitlines()) + '</p>')
+            raise e
+        with stage('render.to_local'):
+            parser.result = parser.to_local()
+        # Convert WebP images while other chapters are rendered.
+        for oimg in parser.images:
+            if oimg.epub_path.endswith('.webp'):
+                oimg.fallback = submit_convert(self.cfg, oimg.path)
+        return parser
 
     def add_chapter(self, chapter, content: str, division_name: str,
-                    is_linear: bool):
+                    is_linear: bool, parser: ContentParser = None):
         chapter_title = chapter['chapter_title']
         chapter_id = chapter['chapter_id']
         ch = epub.EpubHtml(
@@ -360,15 +600,9 @@ class EpubFile:
             uid=f'ch{chapter_id}',
         )
         ch.is_linear = is_linear
-        parser = ContentParser(self.cfg, chapter_id)
-        contents = content.splitlines()
-        try:
-            parser.feed('<p>' + '</p>\n<p>'.join(contents) + '</p>')
-        except Exception as e:
-            print('<p>' + '</p>\n<p>'.join(contents) + '</p>')
-            raise e
-        parser.close()
-        ch.content = f'<h1 style="text-align: center;">{chapter_title}</h1>\n{parser.to_local()}'  # noqa: E501
+        if parser is None:
+            parser = self.render_chapter(chapter, content)
+        ch.content = f'<h1 style="text-align: center;">{chapter_title}</h1>\n{parser.result}'  # noqa: E501
         self.epub.add_item(ch)
         count = 0
         for oimg in parser.images:
@@ -379,22 +613,18 @@ class EpubFile:
             self.epub.add_item(img)
             if oimg.epub_path.endswith('.webp'):
                 img.media_type = 'image/webp'
-                jpg_path = perform_convert(oimg.path)
-                if jpg_path is not None:
-                    jpg_img = EpubPathImage()
-                    jpg_img.file_name = os.path.basename(jpg_path)
-                    jpg_img.path = jpg_path
-                    jpg_img.id = img.id + 'f'
-                    img.fallback = jpg_img.id
-                    self.epub.add_item(jpg_img)
+                # The fallback is removed when saving if the conversion
+                # failed.
+                jpg_img = EpubPathImage()
+                # Cached files may be shared by several URLs.
+                jpg_img.file_name = os.path.splitext(oimg.epub_path)[0] + '_fallback.jpg'  # noqa: E501
+                jpg_img.converting = True
+                jpg_img.id = img.id + 'f'
+                img.fallback = jpg_img.id
+                self.epub.add_item(jpg_img)
+                self.fallbacks.append((img, jpg_img, oimg.fallback))
             count += 1
-        if self.last_division_name != division_name:
-            self.EpubList.append([epub.Link(ch.file_name, division_name), []])
-            self.last_division_name = division_name
-        if isinstance(self.EpubList[-1], list):
-            self.EpubList[-1][-1].append(ch)
-        else:
-            self.EpubList.append(ch)
+        self.__add_to_toc(ch, division_name)
         self.epub.spine.append(ch)
         if self.cfg.add_images_to_single_page and parser.footnote:
             ch_img = epub.EpubHtml(
@@ -407,6 +637,7 @@ class EpubFile:
             ch_img.content = parser.footnote
             self.epub.add_item(ch_img)
             self.epub.spine.append(ch_img)
+        self.__stream()
 
     def add_nodownload_chapter(self, chapter, division_name: str,
                                is_linear: bool):
@@ -421,22 +652,76 @@ class EpubFile:
         ch.is_linear = is_linear
         ch.content = f'<h1 style="text-align: center;">{chapter_title}</h1>\n<p>本章未下载</p>'  # noqa: E501
         self.epub.add_item(ch)
-        if self.last_division_name != division_name:
-            self.EpubList.append([epub.Link(ch.file_name, division_name), []])
-            self.last_division_name = division_name
-        if isinstance(self.EpubList[-1], list):
-            self.EpubList[-1][-1].append(ch)
-        else:
-            self.EpubList.append(ch)
+        self.__add_to_toc(ch, division_name)
         self.epub.spine.append(ch)
+        self.__stream()
+
+    def can_reuse_chapter(self, chapter) -> bool:
+        # Whether the chapter can be copied from the existing EPUB file.
+        if self.old is None:
+            return False
+        chapter_id = str(chapter['chapter_id'])
+        ids = self.old.chapters.get(chapter_id)
+        if not ids or f'ch{chapter_id}' not in ids:
+            return False
+        if self.old.titles.get(f'ch{chapter_id}') != chapter['chapter_title']:  # noqa: E501
+            return False
+        return all(self.old.get_info(self.old.items[i][0]) is not None
+                   for i in ids)
+
+    def add_reused_chapter(self, chapter, division_name: str,
+                           is_linear: bool):
+        # Add a chapter copied from the existing EPUB file. Must be checked
+        # by can_reuse_chapter first.
+        chapter_title = chapter['chapter_title']
+        chapter_id = str(chapter['chapter_id'])
+        for uid in self.old.chapters[chapter_id]:
+            href, media_type, fallback = self.old.items[uid]
+            raw = (self.old.zip, self.old.get_info(href))
+            if uid == f'ch{chapter_id}':
+                ch = EpubRawHtml(uid, href, chapter_title, raw,
+                                 self.old.pages.get(href, []))
+                ch.is_linear = is_linear
+                self.epub.add_item(ch)
+                self.__add_to_toc(ch, division_name)
+                self.epub.spine.append(ch)
+            elif uid == f'ch{chapter_id}_img':
+                ch_img = EpubRawHtml(uid, href, f"{chapter_title} (图片)", raw,
+                                     self.old.pages.get(href, []))
+                ch_img.is_linear = False
+                self.epub.add_item(ch_img)
+                self.epub.spine.append(ch_img)
+            else:
+                img = EpubRawItem(uid, href, media_type, raw)
+                img.fallback = fallback
+                self.epub.add_item(img)
+        self.__stream()
 
     def save_epub_file(self):  # save epub file to local
         # the path to save epub file to local
+        self.__resolve_fallbacks()
+        self.__stream()
         self.epub.toc = self.EpubList
         self.epub.add_item(epub.EpubNcx()), self.epub.add_item(epub.EpubNav())
-        book = EpubWriter(self.out, self.epub, {})
+        # Chapters of the old file are copied, and a streamed file is not
+        # complete until now, so write to another file in these cases.
+        out = self.out
+        if self.old is not None or self.cfg.streaming_epub:
+            out = self.out + '.tmp'
+        if self.cfg.streaming_epub:
+            book = self.writer
+        else:
+            book = EpubWriter(out, self.epub, {})
         book.process()
         try:
-            book.write()
+            with stage('epub.write'):
+                book.write()
         except IOError:
             print_exc()
+            if self.old is not None:
+                self.old.close()
+            return
+        if self.old is not None:
+            self.old.close()
+        if out != self.out:
+            os.replace(out, self.out)
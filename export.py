@@ -1,49 +1,144 @@
 from novelCiwei import NovelCiwei
-from db import CwmDb
+from db import CwmDb, reset_shared_dbs
 from config import Config
 from key import import_keys
 from booksnew import BooksNew
-from crypto import decrypt
+from crypto import decrypt_batch, decrypt_with_keys
 from os.path import dirname
-from os import makedirs
-from epub import EpubFile
-from utils import ask_choice
-import json
+from os import makedirs, stat
+from utils import ask_choice, open_text_file, ordered_map
+from vault import get_vault
+from profiler import stage
+import profiler
+import progress
 from random import choice
+from hashlib import sha256
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threading import RLock
+from itertools import chain
+from typing import List, Optional, Set
 
 
 key_imported = False
 key_force_imported = False
+# Chapters are decrypted in several threads but share one CwmDb.
+key_lock = RLock()
+# Number of chapters read and decrypted together by export_book.
+CHUNK_SIZE = 8
+# Output of jsonl records, opened by open_jsonl
+_jsonl = None
 
 
 def get_key(db: CwmDb, cfg: Config, chapter_id: int):
     global key_imported
-    keys = db.get_key(chapter_id)
-    if len(keys) == 0:
-        if key_imported:
-            raise ValueError('The key is not found.')
-        else:
-            import_keys(cfg.key, db)
-            key_imported = True
+    with key_lock:
         keys = db.get_key(chapter_id)
         if len(keys) == 0:
-            raise ValueError('The key is not found.')
+            if key_imported:
+                raise ValueError('The key is not found.')
+            else:
+                with stage('import_keys'):
+                    import_keys(cfg.key, db)
+                key_imported = True
+            keys = db.get_key(chapter_id)
+            if len(keys) == 0:
+                raise ValueError('The key is not found.')
     return keys
 
 
-def try_decrypt(db: CwmDb, cfg: Config, content, chapter_id: int):
+def try_decrypt_batch(db: CwmDb, cfg: Config, items) -> List[str]:
+    # items are (content, chapter_id) pairs.
     global key_force_imported
-    keys = get_key(db, cfg, chapter_id)
-    for key in keys:
-        try:
-            return decrypt(content, key).decode()
-        except Exception:
-            pass
-    if not key_force_imported:
-        import_keys(cfg.key, db, True)
-        key_force_imported = True
-        return try_decrypt(db, cfg, content, chapter_id)
-    raise ValueError('Failed to decrypt the content.')
+    keys = [get_key(db, cfg, chapter_id) for _, chapter_id in items]
+    with stage('decrypt'):
+        results = decrypt_batch(zip([i[0] for i in items], keys))
+    if None in results and not key_force_imported:
+        with stage('decrypt.retry'):
+            with key_lock:
+                if not key_force_imported:
+                    import_keys(cfg.key, db, True)
+                    key_force_imported = True
+            for i, (content, chapter_id) in enumerate(items):
+                if results[i] is None:
+                    results[i] = decrypt_with_keys(
+                        content, get_key(db, cfg, chapter_id))
+    if None in results:
+        raise ValueError('Failed to decrypt the content.')
+    return results
+
+
+def open_jsonl(cfg: Config):
+    # Records are written to stdout unless jsonl_output is set. Messages
+    # are printed to stderr then.
+    global _jsonl
+    if cfg.jsonl_output == '-':
+        _jsonl = sys.stdout.buffer
+        sys.stdout = sys.stderr
+    else:
+        d = dirname(cfg.jsonl_output)
+        if d:
+            makedirs(d, exist_ok=True)
+        _jsonl = open(cfg.jsonl_output, 'wb')
+
+
+def close_jsonl():
+    global _jsonl
+    if _jsonl is None:
+        return
+    try:
+        if _jsonl is sys.__stdout__.buffer:
+            _jsonl.flush()
+        else:
+            _jsonl.close()
+    except BrokenPipeError:
+        pass
+    _jsonl = None
+
+
+def write_jsonl(record: dict):
+    # Writing blocks while the reader is behind, so no more chapters are
+    # read ahead than the pipeline of export_book holds.
+    _jsonl.write(json.dumps(record, ensure_ascii=False).encode() + b'\n')
+
+
+def try_decrypt(db: CwmDb, cfg: Config, content, chapter_id: int):
+    return try_decrypt_batch(db, cfg, [(content, chapter_id)])[0]
+
+
+def get_hash(content: str):
+    return sha256(content.encode()).hexdigest()
+
+
+def load_texts(db: CwmDb, cfg: Config, book_id: int, items,
+               hashes: Optional[List[str]] = None,
+               stored: Optional[dict] = None) -> List[str]:
+    # items are (content, chapter_id) pairs. Texts are read from the vault
+    # and only chapters which are not stored or changed since then are
+    # decrypted. stored is the result of get_hashes of the book, so the
+    # vault is not queried for chapters not in it.
+    vault = get_vault(cfg)
+    if vault is None:
+        return try_decrypt_batch(db, cfg, items)
+    if hashes is None:
+        hashes = [get_hash(content) for content, _ in items]
+    lookup = [i for i, (_, chapter_id) in enumerate(items)
+              if stored is None or stored.get(int(chapter_id)) == hashes[i]]
+    texts = [None] * len(items)
+    with stage('vault.get'):
+        for i, text in zip(lookup, vault.get_contents(
+                [(items[i][1], hashes[i]) for i in lookup])):
+            texts[i] = text
+    missing = [i for i, text in enumerate(texts) if text is None]
+    if missing:
+        decrypted = try_decrypt_batch(db, cfg, [items[i] for i in missing])
+        for i, text in zip(missing, decrypted):
+            texts[i] = text
+        with stage('vault.set'):
+            vault.set_contents(book_id, [
+                (items[i][1], hashes[i], texts[i]) for i in missing])
+    return texts
 
 
 def export_chapter(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew,
@@ -51,35 +146,54 @@ def export_chapter(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew,
     chapter = ncw.get_chapter(chapter_id)
     book_id = int(chapter['book_id'])
     raw_content = bn.get_chapter(book_id, chapter_id)
-    content = try_decrypt(db, cfg, raw_content, chapter_id)
+    content = load_texts(db, cfg, book_id, [(raw_content, chapter_id)])[0]
     filename = cfg.get_export_chapter(chapter)
     d = dirname(filename)
     makedirs(d, exist_ok=True)
-    with open(filename, 'w', encoding='UTF-8') as f:
+    with open_text_file(filename, cfg.compress_level) as f:
         f.write(chapter['chapter_title'] + '\n')
         f.write(content)
 
 
 def export_book(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew,
-                book_id: int):
-    book = ncw.get_book_in_shelf(book_id)
-    if book is None:
-        book = ncw.get_book_in_readhistory(book_id)
+                book_id: int, reuse: Optional[Set[int]] = None):
+    # reuse is the IDs of chapters which can be copied from the existing
+    # EPUB file instead of being rendered again.
+    profiler.begin_book(book_id)
+    error = None
+    try:
+        _export_book(ncw, db, cfg, bn, book_id, reuse)
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        profiler.end_book()
+        progress.book_end(book_id, error)
+
+
+def _export_book(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew,
+                 book_id: int, reuse: Optional[Set[int]]):
+    book = ncw.get_book(book_id)
     if book is None:
         raise ValueError('The book is not found.')
     if cfg.export_txt:
-        txt_filename = cfg.get_export_book(book, 'txt')
+        txt_filename = cfg.get_export_book(book, cfg.txt_ext)
         d = dirname(txt_filename)
         makedirs(d, exist_ok=True)
-        txt = open(txt_filename, 'w', encoding='UTF-8')
+        txt = open_text_file(txt_filename, cfg.compress_level)
     if cfg.export_epub:
+        # ebooklib, lxml and requests are only loaded to export EPUB files.
+        from epub import EpubFile
+        from image_cache import get_image_urls, prefetch
         try:
-            epub = EpubFile(cfg, cfg.get_export_book(book, 'epub'))
+            epub = EpubFile(cfg, cfg.get_export_book(book, 'epub'),
+                            reuse is not None)
             epub.set_book(book)
         except Exception as e:
             if cfg.export_txt:
                 txt.close()
             raise e
+    contents = None
     try:
         chapters = ncw.get_chapter_with_bookid(book_id)
         divisions = ncw.get_divisions_with_bookid(book_id)
@@ -91,55 +205,440 @@ def export_book(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew,
                 maps[division_id].append(chapter)
             else:
                 maps[division_id] = [chapter]
+        # Load keys and marks of the whole book with one query each.
+        with key_lock:
+            db.get_keys([c['chapter_id'] for c in chapters
+                         if c['is_download']])
+        marks = db.get_marks([d['division_id'] for d in divisions])
+        # (division, is_linear, chapter, chapter_index) in output order.
+        # chapter is None for the division header itself.
+        entries = []
         for division in divisions:
-            division_name = division['division_name']
             division_id = division['division_id']
-            is_linear = db.get_mark(division_id)
-            if cfg.export_txt:
-                txt.write(f"第{division['division_index']}卷 {division_name}\n")
-                if division['description']:
-                    txt.write(division['description'] + '\n\n')
-            if cfg.export_epub and division['description']:
-                print('TODO: add division description to epub.')
+            is_linear = marks[int(division_id)]
+            entries.append((division, is_linear, None, 0))
             if division_id not in maps:
                 continue
             chapter_index = 1
             for chapter in maps[division_id]:
-                chapter_id = chapter['chapter_id']
-                chapter_title = chapter['chapter_title']
-                if chapter['is_download']:
-                    raw_content = bn.get_chapter(book_id, chapter_id)
-                    content = try_decrypt(db, cfg, raw_content, chapter_id)
-                    if cfg.export_txt:
-                        txt.write(f"第{chapter_index}章 {chapter_title}\n")
-                        txt.write(content + '\n\n')
-                    if cfg.export_epub:
-                        epub.add_chapter(chapter, content, division_name,
-                                         is_linear)
-                    count += 1
-                elif cfg.export_nodownload:
-                    if cfg.export_txt:
-                        txt.write(f"第{chapter_index}章 {chapter_title} (未下载)\n\n")  # noqa: E501
-                    if cfg.export_epub:
-                        epub.add_nodownload_chapter(chapter, division_name,
-                                                    is_linear)
+                if chapter['is_download'] or cfg.export_nodownload:
+                    entries.append((division, is_linear, chapter,
+                                    chapter_index))
                 chapter_index += 1
+
+        if cfg.export_sqlite:
+            from search import get_search_db
+            search = get_search_db(cfg)
+            search.set_book(book, divisions, chapters)
+            # Hashes of the encrypted chapters in the search database
+            indexed = search.get_hashes(book_id)
+        vault = get_vault(cfg)
+        stored = vault.get_hashes(book_id) if vault is not None else None
+
+        # Chapters copied from the existing EPUB file
+        reused = set()
+        if cfg.export_epub and reuse:
+            reused = {c['chapter_id'] for c in chapters
+                      if c['is_download'] and int(c['chapter_id']) in reuse
+                      and epub.can_reuse_chapter(c)}
+
+        def load_chapters(chunk):
+            chapter_ids = [c['chapter_id'] for c in chunk]
+            raw_contents = bn.get_chapters(book_id, chapter_ids)
+            changed = range(len(chunk))
+            hashes = None
+            if cfg.export_sqlite or vault is not None:
+                hashes = [get_hash(c) for c in raw_contents]
+            if cfg.export_sqlite:
+                changed = [i for i, c in enumerate(chapter_ids)
+                           if indexed.get(int(c)) != hashes[i]]
+            if cfg.export_txt or cfg.export_epub or cfg.export_jsonl:
+                texts = load_texts(
+                    db, cfg, book_id, list(zip(raw_contents, chapter_ids)),
+                    hashes, stored)
+            else:
+                # Only chapters changed since they were indexed are loaded.
+                texts = [None] * len(chunk)
+                for i, text in zip(changed, load_texts(db, cfg, book_id, [
+                        (raw_contents[i], chapter_ids[i]) for i in changed],
+                        [hashes[i] for i in changed], stored)):
+                    texts[i] = text
+            if cfg.export_sqlite:
+                search.set_contents([(chapter_ids[i], hashes[i], texts[i])
+                                     for i in changed])
+            if not cfg.export_epub:
+                return [(text, None) for text in texts]
+            # Download images of the chunk concurrently before rendering.
+            prefetch(cfg, chain.from_iterable(
+                get_image_urls(text) for chapter, text in zip(chunk, texts)
+                if chapter['chapter_id'] not in reused))
+            return [(text, None if chapter['chapter_id'] in reused
+                     else epub.render_chapter(chapter, text))
+                    for chapter, text in zip(chunk, texts)]
+        # Chapters are read, decrypted and rendered ahead in a thread pool
+        # and consumed here in order.
+        need_text = cfg.export_txt or cfg.export_jsonl
+        downloaded = [e[2] for e in entries
+                      if e[2] is not None and e[2]['is_download'] and (
+                          need_text or e[2]['chapter_id'] not in reused)]
+        chunk_size, threads = CHUNK_SIZE, cfg.threads
+        if cfg.export_jsonl and not (
+                cfg.export_txt or cfg.export_epub or cfg.export_sqlite):
+            # Each record is written as soon as its chapter is decrypted,
+            # and the next chapter is only read after that.
+            chunk_size, threads = 1, 1
+        contents = ordered_map(load_chapters, [
+            downloaded[i:i + chunk_size]
+            for i in range(0, len(downloaded), chunk_size)
+        ], threads)
+        loaded = chain.from_iterable(contents)
+        progress.book_start(book_id, sum(
+            1 for e in entries if e[2] is not None and e[2]['is_download']))
+        for division, is_linear, chapter, chapter_index in entries:
+            division_name = division['division_name']
+            if chapter is None:
+                if cfg.export_txt:
+                    txt.write(f"第{division['division_index']}卷 {division_name}\n")  # noqa: E501
+                    if division['description']:
+                        txt.write(division['description'] + '\n\n')
+                if cfg.export_epub and division['description']:
+                    print('TODO: add division description to epub.')
+                continue
+            chapter_title = chapter['chapter_title']
+            if chapter['is_download']:
+                content = None
+                if need_text or chapter['chapter_id'] not in reused:
+                    content, parser = next(loaded)
+                if cfg.export_txt:
+                    txt.write(f"第{chapter_index}章 {chapter_title}\n")
+                    txt.write(content + '\n\n')
+                if cfg.export_epub:
+                    if chapter['chapter_id'] in reused:
+                        epub.add_reused_chapter(chapter, division_name,
+                                                is_linear)
+                    else:
+                        epub.add_chapter(chapter, content, division_name,
+                                         is_linear, parser)
+                count += 1
+                progress.chapter(chapter['chapter_id'], content)
+            else:
+                if cfg.export_txt:
+                    txt.write(f"第{chapter_index}章 {chapter_title} (未下载)\n\n")  # noqa: E501
+                if cfg.export_epub:
+                    epub.add_nodownload_chapter(chapter, division_name,
+                                                is_linear)
+            if cfg.export_jsonl:
+                write_jsonl({
+                    'book_id': book_id,
+                    'division': {
+                        'division_id': int(division['division_id']),
+                        'division_index': division['division_index'],
+                        'division_name': division_name},
+                    'chapter_id': int(chapter['chapter_id']),
+                    'chapter_index': chapter_index, 'title': chapter_title,
+                    'text': content if chapter['is_download'] else None})
+        progress.clear()
         print(f'Exported {count} chapters.')
+        if reused:
+            print(f'Reused {len(reused)} chapters of the existing EPUB file.')
+        if cfg.export_jsonl:
+            _jsonl.flush()
     finally:
+        if contents is not None:
+            contents.close()
         if cfg.export_txt:
             txt.close()
         if cfg.export_epub:
             epub.save_epub_file()
 
 
-def export_all(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew):
-    books = ncw.get_all_books()
-    for book in books:
-        book_id = int(book[0])
+def get_export_manifests_template(cfg: Config):
+    # Hash of the options which change the content of exported files.
+    return sha256(json.dumps([
+        cfg.export_book_template, cfg.export_nodownload,
+        cfg.add_images_to_single_page]).encode()).hexdigest()
+
+
+def get_export_manifests(ncw: NovelCiwei, db: CwmDb, cfg: Config,
+                         bn: BooksNew, books: Optional[List[int]] = None):
+    # The manifest of every book, or only of books, as export_book would
+    # record it now, without outputs. Keys are book IDs. chapters are
+    # [chapter_id, size, stamp] of downloaded chapters, so rewritten
+    # chapters are found.
+    template = get_export_manifests_template(cfg)
+    if books is None:
+        all_chapters = ncw.get_all_chapters()
+        all_divisions = ncw.get_all_divisions()
+    else:
+        all_chapters = chain.from_iterable(
+            ncw.get_chapter_with_bookid(book_id) for book_id in books)
+        all_divisions = chain.from_iterable(
+            ncw.get_divisions_with_bookid(book_id) for book_id in books)
+    catalogs = {}
+    chapters = {}
+    for c in all_chapters:
+        book_id = int(c['book_id'])
+        if book_id not in catalogs:
+            catalogs[book_id] = sha256()
+            chapters[book_id] = []
+        catalogs[book_id].update(json.dumps([
+            str(c['chapter_id']), str(c['division_id']), c['chapter_index'],
+            c['chapter_title'], c['is_download']]).encode())
+        if c['is_download']:
+            chapters[book_id].append(int(c['chapter_id']))
+    divisions = [(int(d['book_id']), [
+        str(d['division_id']), d['division_index'], d['division_name'],
+        d['description']]) for d in all_divisions]
+    marks = db.get_marks([d[1][0] for d in divisions])
+    for book_id, division in divisions:
+        if book_id in catalogs:
+            division.append(marks[int(division[0])])
+            catalogs[book_id].update(json.dumps(division).encode())
+    manifests = {}
+    for book_id, h in catalogs.items():
+        h.update(json.dumps(ncw.get_book(book_id), sort_keys=True).encode())
+        stamps = bn.get_stamps(book_id, chapters[book_id])
+        manifests[book_id] = {
+            'chapters': [[i] + (stamps[i] or [None, None])
+                         for i in sorted(chapters[book_id])],
+            'export_type': cfg.export_type, 'image_type': cfg.image_type,
+            'template': template, 'catalog': h.hexdigest()}
+    return manifests
+
+
+def get_book_outputs(ncw: NovelCiwei, cfg: Config, book_id: int):
+    # Return {path: [size, mtime]} of the files written by export_book.
+    # A missing file is None.
+    book = ncw.get_book(book_id)
+    outputs = {}
+    if book is None:
+        return outputs
+    paths = []
+    if cfg.export_txt:
+        paths.append(cfg.get_export_book(book, cfg.txt_ext))
+    if cfg.export_epub:
+        paths.append(cfg.get_export_book(book, 'epub'))
+    for path in paths:
         try:
-            export_book(ncw, db, cfg, bn, book_id)
+            st = stat(path)
+            outputs[path] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            outputs[path] = None
+    return outputs
+
+
+def is_book_changed(ncw: NovelCiwei, db: CwmDb, cfg: Config, book_id: int,
+                    manifest: dict):
+    old = db.get_export_manifest(book_id)
+    if old is None:
+        return True
+    outputs = old.pop('outputs')
+    if old != manifest or None in outputs.values():
+        return True
+    if cfg.export_sqlite:
+        from search import get_search_db
+        if not get_search_db(cfg).has_book(book_id):
+            return True
+    return outputs != get_book_outputs(ncw, cfg, book_id)
+
+
+def get_reusable_chapters(ncw: NovelCiwei, db: CwmDb, cfg: Config,
+                          book_id: int, manifest: dict
+                          ) -> Optional[Set[int]]:
+    # IDs of chapters exported to the EPUB file last time and not changed
+    # since then, if the file can be updated in place. manifest is the
+    # current one of the book.
+    if not cfg.export_epub:
+        return None
+    old = db.get_export_manifest(book_id)
+    book = ncw.get_book(book_id)
+    if old is None or book is None:
+        return None
+    if old['export_type'] != cfg.export_type or \
+            old['image_type'] != cfg.image_type or \
+            old['template'] != get_export_manifests_template(cfg):
+        return None
+    path = cfg.get_export_book(book, 'epub')
+    outputs = get_book_outputs(ncw, cfg, book_id)
+    if outputs[path] is None or old['outputs'].get(path) != outputs[path]:
+        return None
+    # Manifests of older versions have no stamps.
+    stamps = {c[0]: c[1:] for c in manifest['chapters']}
+    return {c[0] for c in old['chapters']
+            if isinstance(c, list) and c[1] is not None
+            and stamps.get(c[0]) == c[1:]}
+
+
+def save_export_manifest(ncw: NovelCiwei, db: CwmDb, cfg: Config,
+                         book_id: int, manifest: dict):
+    manifest = dict(manifest)
+    manifest['outputs'] = get_book_outputs(ncw, cfg, book_id)
+    db.set_export_manifest(book_id, manifest)
+
+
+def export_all(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew,
+               books: Optional[List[int]] = None):
+    # books defaults to all books. Only the manifests of given books are
+    # computed.
+    subset = books
+    if books is None:
+        books = [int(book[0]) for book in ncw.get_all_books()]
+    total = len(books)
+    manifests = {}
+    if cfg.incremental:
+        manifests = get_export_manifests(ncw, db, cfg, bn, subset)
+    # Records of every book are streamed again.
+    if cfg.incremental and not cfg.export_jsonl:
+        books = [book_id for book_id in books
+                 if is_book_changed(ncw, db, cfg, book_id,
+                                    manifests[book_id])]
+        if len(books) < total:
+            print(f'Skipped {total - len(books)} unchanged books.')
+    reuse = {}
+    if cfg.incremental:
+        reuse = {book_id: get_reusable_chapters(ncw, db, cfg, book_id,
+                                                manifests[book_id])
+                 for book_id in books}
+    progress.run_start(len(books))
+    if cfg.export_epub:
+        from image_cache import prefetch
+        prefetch(cfg, get_covers(ncw, books))
+    failed = []
+    # Records are written in order by this process.
+    if cfg.jobs > 1 and len(books) > 1 and not cfg.export_jsonl:
+        # Import keys once here instead of once in every worker. Forced, as
+        # try_decrypt_batch would do after a failed decryption, so workers
+        # only read cwm.db. Files imported before are skipped.
+        if cfg.key is not None:
+            with stage('import_keys'):
+                import_keys(cfg.key, db, True)
+        order = {book_id: i for i, book_id in enumerate(books)}
+        with ProcessPoolExecutor(cfg.jobs, initializer=_init_worker,
+                                 initargs=(cfg,)) as pool:
+            futures = {pool.submit(_export_book_worker, book_id,
+                                   reuse.get(book_id)): book_id
+                       for book_id in books}
+            for future in as_completed(futures):
+                book_id = futures[future]
+                try:
+                    error, profiles = future.result()
+                    profiler.merge_books(profiles)
+                except Exception as e:
+                    error = str(e)
+                progress.book_done()
+                if error is not None:
+                    progress.clear()
+                    print(f'Failed to export book {book_id}: {error}')
+                    failed.append((book_id, error))
+                elif book_id in manifests:
+                    save_export_manifest(ncw, db, cfg, book_id,
+                                         manifests[book_id])
+        failed.sort(key=lambda x: order[x[0]])
+    else:
+        for book_id in books:
+            try:
+                export_book(ncw, db, cfg, bn, book_id, reuse.get(book_id))
+            except BrokenPipeError:
+                raise
+            except Exception as e:
+                progress.clear()
+                print(f'Failed to export book {book_id}: {e}')
+                failed.append((book_id, str(e)))
+                continue
+            if book_id in manifests:
+                save_export_manifest(ncw, db, cfg, book_id,
+                                     manifests[book_id])
+    progress.run_end(len(failed))
+    if failed:
+        print(f'Failed to export {len(failed)} of {total} books:')
+        for book_id, error in failed:
+            print(f'{book_id}: {error}')
+
+
+def get_covers(ncw: NovelCiwei, books: List[int]):
+    covers = []
+    for book_id in books:
+        book = ncw.get_book(book_id)
+        if book is not None:
+            covers.append(book['cover'])
+    return covers
+
+
+def warm_image_cache(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew):
+    # Download covers and images of downloaded chapters which are not in the
+    # image cache yet.
+    from image_cache import get_image_urls, prefetch
+    if cfg.book_id is not None:
+        books = [cfg.book_id]
+    else:
+        books = [int(book[0]) for book in ncw.get_all_books()]
+    fetched, failed = prefetch(cfg, get_covers(ncw, books))
+    for book_id in books:
+        chapter_ids = [c['chapter_id']
+                       for c in ncw.get_chapter_with_bookid(book_id)
+                       if c['is_download']]
+        with key_lock:
+            db.get_keys(chapter_ids)
+
+        def load_images(chunk):
+            raw_contents = bn.get_chapters(book_id, chunk)
+            texts = load_texts(db, cfg, book_id,
+                               list(zip(raw_contents, chunk)))
+            return prefetch(cfg, chain.from_iterable(
+                get_image_urls(text) for text in texts))
+        results = ordered_map(load_images, [
+            chapter_ids[i:i + CHUNK_SIZE]
+            for i in range(0, len(chapter_ids), CHUNK_SIZE)
+        ], cfg.threads)
+        try:
+            for count, urls in results:
+                fetched += count
+                failed += urls
         except Exception as e:
-            print(f'Failed to export book {book_id}: {e}')
+            print(f'Failed to scan book {book_id}: {e}')
+        finally:
+            results.close()
+    print(f'Downloaded {fetched} images.')
+    if failed:
+        print(f'Failed to download {len(failed)} images:')
+        for url in failed:
+            print(url)
+
+
+# Handles opened by each process of the export_all process pool.
+_worker = None
+
+
+def _init_worker(cfg: Config):
+    global _worker, key_imported, key_force_imported
+    # Keys were imported by the parent process.
+    key_imported = key_force_imported = cfg.key is not None
+    if cfg.profile is not None:
+        profiler.enable()
+    # The parent process shows the status line.
+    if cfg.progress_log is not None:
+        progress.enable(cfg.progress_log, False)
+    else:
+        progress.close()
+    reset_shared_dbs()
+    if cfg.export_epub:
+        from image_cache import reset as reset_image_cache
+        from transcode import reset as reset_transcode
+        reset_image_cache()
+        reset_transcode()
+    _worker = (NovelCiwei(cfg.cwmdb, cfg.cwmdb_snapshot), CwmDb(cfg.db), cfg,
+               BooksNew(cfg.booksnew))
+
+
+def _export_book_worker(book_id: int, reuse: Optional[Set[int]]):
+    # Return the error and the profile of the book.
+    ncw, db, cfg, bn = _worker
+    error = None
+    try:
+        export_book(ncw, db, cfg, bn, book_id, reuse)
+    except Exception as e:
+        error = str(e)
+    return error, profiler.pop_books()
 
 
 class ExportCli:
@@ -167,16 +666,16 @@ class ExportCli:
 
     def ask_book(self):
         if self.shelf == 'readhistory':
-            books = [json.loads(b['book_info']) for b in self.ncw.get_read_history()]  # noqa: E501
+            books = list(self.ncw.get_history_books().values())
         elif self.shelf == 'all':
             bookids = [int(b[0]) for b in self.ncw.get_all_books()]
             books = []
             for bid in bookids:
-                book = self.ncw.get_book_in_shelf(bid) or self.ncw.get_book_in_readhistory(bid)  # noqa: E501
+                book = self.ncw.get_book(bid)
                 if book:
                     books.append(book)
         else:
-            books = [json.loads(b['book_info']) for b in self.shelfs[self.shelf]]  # noqa: E501
+            books = [self.ncw.get_book_in_shelf(b['book_id']) for b in self.shelfs[self.shelf]]  # noqa: E501
         self.book = ask_choice(self.cfg, books, '请选择书：', lambda b: f"{b['book_name']} - {b['author_name']}", [('b', '返回', 'back')])  # noqa: E501
         if self.book == 'back':
             self.fns.append(self.ask_shelf)
@@ -202,11 +701,14 @@ class ExportCli:
         if self.action == 'mark':
             extras.append(('q', '退出', 'quit'))
 
+        if self.action == 'mark':
+            marks = self.db.get_marks([d['division_id'] for d in divisions])
+
         def show_division(division):
             name = division['division_name']
             if self.action == 'mark':
                 division_id = int(division['division_id'])
-                if not self.db.get_mark(division_id):
+                if not marks[division_id]:
                     name += ' (非线性卷)'
             return name
         division = ask_choice(self.cfg, divisions, '请选择卷：', show_division, extras)  # noqa: E501
@@ -235,7 +737,8 @@ class ExportCli:
 
         def show_shelf(shelf: str):
             data = f"{shelf} ({len(self.shelfs[shelf])} 本书)"
-            book = json.loads(choice(self.shelfs[shelf])['book_info'])
+            book = self.ncw.get_book_in_shelf(
+                choice(self.shelfs[shelf])['book_id'])
             data += f"\n书架内有 {book['book_name']} - {book['author_name']}"
             return data
         self.shelf = ask_choice(self.cfg, [i for i in self.shelfs.keys()],
@@ -1,34 +1,414 @@
 from urllib.parse import urlparse
-from os.path import exists, join, dirname
-from os import makedirs
+from os.path import basename, exists, getsize, join, dirname, relpath
+from os import getpid, makedirs, remove, replace
+from threading import BoundedSemaphore, Lock, RLock, get_ident
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import sha256
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
 from config import Config
-import requests
+from html.parser import HTMLParser
+from profiler import stage, trace_sql
+import progress
+import re
+import sqlite3
 
 
-def try_fetch(url):
-    for _ in range(5):
+# python-magic or filetype, imported by can_guess_mime on first use
+magic = None
+filetype = None
+have_magic = None
+have_filetype = None
+
+
+# The index of the image cache, stored in the cache directory.
+INDEX_NAME = '.index.db'
+INDEX_TABLES = ['''CREATE TABLE IF NOT EXISTS images (
+url TEXT PRIMARY KEY,
+hash TEXT
+);''', 'CREATE INDEX IF NOT EXISTS images_hash ON images(hash);',
+                '''CREATE TABLE IF NOT EXISTS blobs (
+hash TEXT PRIMARY KEY,
+path TEXT,
+mime TEXT,
+size INT,
+fallback TEXT,
+fallback_size INT,
+last_access INT,
+fallback_error TEXT
+);''', 'CREATE INDEX IF NOT EXISTS blobs_path ON blobs(path);',
+                'CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs(last_access);',  # noqa: E501
+                '''CREATE TABLE IF NOT EXISTS meta (
+key TEXT PRIMARY KEY,
+value TEXT
+);''']
+# Bytes read to guess the mimetype of an image.
+MIME_HEADER_SIZE = 4096
+IMG_TAG = re.compile(r'<img', re.I)
+
+# Downloads of all threads share one keep-alive session and one thread pool.
+_lock = RLock()
+_session = None
+_executor = None
+# Limits the number of concurrent downloads of each host.
+_hosts: Dict[str, BoundedSemaphore] = {}
+# Downloads in progress by URL
+_pending: Dict[str, Future] = {}
+# Opened indexes by cache directory
+_caches: Dict[str, 'ImageCache'] = {}
+
+
+def reset():
+    # Drop the session, thread pool and indexes inherited from the parent
+    # process.
+    global _lock, _session, _executor, _hosts, _pending, _caches
+    _lock = RLock()
+    _session = None
+    _executor = None
+    _hosts = {}
+    _pending = {}
+    _caches = {}
+
+
+def can_guess_mime() -> bool:
+    global magic, filetype, have_magic, have_filetype
+    if have_magic is not None:
+        return have_magic or have_filetype
+    try:
+        import magic
+        have_magic = True
+        have_filetype = False
+    except ImportError:
+        have_magic = False
         try:
-            re = requests.get(url=url)
+            import filetype
+            have_filetype = True
+        except ImportError:
+            have_filetype = False
+            print('Warning: python-magic or filetype not found. The mimetype in EPUB file may wrong.')  # noqa: E501
+            import platform
+            if platform.system() == "Windows":
+                print('python-magic-bin is also needed on Windows if you use magic.')  # noqa: E501
+    return have_magic or have_filetype
+
+
+def guess_mime(data: bytes) -> Optional[str]:
+    if not can_guess_mime():
+        return None
+    if have_magic:
+        return magic.from_buffer(data, True)
+    if have_filetype:
+        return filetype.guess_mime(data)
+
+
+def get_session(cfg: Config):
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=cfg.download_threads)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def get_host_semaphore(cfg: Config, url: str) -> BoundedSemaphore:
+    host = urlparse(url).netloc
+    with _lock:
+        if host not in _hosts:
+            _hosts[host] = BoundedSemaphore(cfg.host_connections)
+        return _hosts[host]
+
+
+def try_fetch(cfg: Config, url):
+    from requests import RequestException
+    session = get_session(cfg)
+    with get_host_semaphore(cfg, url), stage('image.fetch'):
+        error = None
+        for _ in range(5):
+            try:
+                re = session.get(url=url)
+            except RequestException as e:
+                error = e
+                continue
             if re.status_code == 200:
                 return re.content
-        except Exception:
-            pass
-        raise ValueError(f'HTTP ERROR {re.status_code} {re.reason}.')
-    raise ValueError('Failed to fetch the image.')
+            raise ValueError(f'HTTP ERROR {re.status_code} {re.reason}.')
+    raise ValueError(f'Failed to fetch the image: {error}')
 
 
-def get_cache(cfg: Config, url: str):
+def get_cache_path(cfg: Config, url: str):
     u = urlparse(url)
     path = u.path
     if path.endswith('/'):
         path = path[:-1]
-    path = join(cfg.img_cache_dir, path[1:])
-    if exists(path):
-        return path
-    else:
-        img = try_fetch(url)
-        d = dirname(path)
-        makedirs(d, exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(img)
-        return path
+    return join(cfg.img_cache_dir, path[1:])
+
+
+# Collects src of images in content
+class ImageScanner(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'img':
+            src = dict(attrs).get('src')
+            if src:
+                self.urls.append(src)
+
+
+def get_image_urls(content: str):
+    # Most chapters have no image, so skip parsing them.
+    if IMG_TAG.search(content) is None:
+        return []
+    scanner = ImageScanner()
+    scanner.feed(content)
+    scanner.close()
+    return scanner.urls
+
+
+class CachedImage:
+    def __init__(self, path: str, name: str, mime: Optional[str], size: int,
+                 fallback: Optional[str]):
+        # The path of the cached file
+        self.path = path
+        # The file name derived from the URL
+        self.name = name
+        # None if neither magic nor filetype is available
+        self.mime = mime
+        self.size = size
+        # The path of the converted JPEG image
+        self.fallback = fallback
+
+
+class ImageCache:
+    # Maps URLs to cached files. Files with the same content are stored
+    # once. Files not used by this process are evicted in LRU order when
+    # the cache is larger than cfg.image_cache_size.
+    def __init__(self, cfg: Config):
+        self._cfg = cfg
+        self._dir = cfg.img_cache_dir
+        makedirs(self._dir, exist_ok=True)
+        self._db = sqlite3.connect(join(self._dir, INDEX_NAME), timeout=60,
+                                   check_same_thread=False)
+        trace_sql(self._db, 'image_cache')
+        self._lock = Lock()
+        # Images accessed since then are used by this process.
+        self._start = int(time())
+        with self._lock:
+            for sql in INDEX_TABLES:
+                self._db.execute(sql)
+            cur = self._db.execute('PRAGMA table_info(blobs);')
+            if 'fallback_error' not in [i[1] for i in cur]:
+                self._db.execute(
+                    'ALTER TABLE blobs ADD COLUMN fallback_error TEXT;')
+            self._db.commit()
+
+    def find(self, url: str) -> Optional[CachedImage]:
+        # Return None if the image is not cached.
+        with self._lock:
+            cur = self._db.execute('SELECT b.hash, b.path, b.mime, b.size, b.fallback, b.last_access FROM images i JOIN blobs b ON i.hash = b.hash WHERE i.url = ?;', [url])  # noqa: E501
+            row = cur.fetchone()
+            if row is not None:
+                image = self.__load(url, *row)
+                if image is not None:
+                    return image
+            # Files cached before the index was added
+            path = get_cache_path(self._cfg, url)
+            if not exists(path):
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            return self.__add(url, data, path)
+
+    def __load(self, url, hash, path, mime, size, fallback, last_access):
+        path = join(self._dir, path)
+        if not exists(path):
+            self.__remove(hash)
+            self._db.commit()
+            return None
+        if mime is None and can_guess_mime():
+            with open(path, 'rb') as f:
+                mime = guess_mime(f.read(MIME_HEADER_SIZE))
+            self._db.execute('UPDATE blobs SET mime = ? WHERE hash = ?;',
+                             [mime, hash])
+        if fallback is not None:
+            fallback = join(self._dir, fallback)
+            if not exists(fallback):
+                fallback = None
+                self._db.execute('UPDATE blobs SET fallback = NULL, fallback_size = NULL WHERE hash = ?;', [hash])  # noqa: E501
+        if last_access < self._start:
+            self._db.execute('UPDATE blobs SET last_access = ? WHERE hash = ?;',  # noqa: E501
+                             [int(time()), hash])
+        if self._db.in_transaction:
+            self._db.commit()
+        name = basename(get_cache_path(self._cfg, url))
+        return CachedImage(path, name, mime, size, fallback)
+
+    def add(self, url: str, data: bytes) -> CachedImage:
+        with self._lock:
+            return self.__add(url, data)
+
+    def __add(self, url: str, data: bytes, path: str = None):
+        # path is the file which already contains data.
+        hash = sha256(data).hexdigest()
+        cur = self._db.execute(
+            'SELECT path FROM blobs WHERE hash = ?;', [hash])
+        row = cur.fetchone()
+        if row is None or not exists(join(self._dir, row[0])):
+            if path is None:
+                path = get_cache_path(self._cfg, url)
+                makedirs(dirname(path), exist_ok=True)
+                # Other processes may fetch the same image at the same time.
+                tmp = f'{path}.{getpid()}.{get_ident()}.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                replace(tmp, path)
+            mime = guess_mime(data[:MIME_HEADER_SIZE])
+            self._db.execute(
+                'INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, NULL, NULL, ?, NULL);',  # noqa: E501
+                [hash, relpath(path, self._dir), mime, len(data), int(time())])
+        self._db.execute('INSERT OR REPLACE INTO images VALUES (?, ?);',
+                         [url, hash])
+        self._db.commit()
+        self.__evict()
+        cur = self._db.execute(
+            'SELECT hash, path, mime, size, fallback, last_access FROM blobs WHERE hash = ?;',  # noqa: E501
+            [hash])
+        return self.__load(url, *cur.fetchone())
+
+    def __remove(self, hash: str):
+        self._db.execute('DELETE FROM images WHERE hash = ?;', [hash])
+        self._db.execute('DELETE FROM blobs WHERE hash = ?;', [hash])
+
+    def __evict(self):
+        budget = self._cfg.image_cache_size
+        if not budget:
+            return
+        cur = self._db.execute('SELECT SUM(size + IFNULL(fallback_size, 0)) FROM blobs;')  # noqa: E501
+        total = cur.fetchone()[0] or 0
+        if total <= budget:
+            return
+        cur = self._db.execute('SELECT hash, path, fallback, size + IFNULL(fallback_size, 0) FROM blobs WHERE last_access < ? ORDER BY last_access;', [self._start])  # noqa: E501
+        for hash, path, fallback, size in cur.fetchall():
+            for p in [path, fallback]:
+                if p is not None and exists(join(self._dir, p)):
+                    remove(join(self._dir, p))
+            self.__remove(hash)
+            total -= size
+            if total <= budget:
+                break
+        self._db.commit()
+
+    def get_fallback(self, path: str) -> Tuple[Optional[str], Optional[str]]:
+        # Return (fallback, error) of the cached file path. Both are None if
+        # it is not converted yet.
+        with self._lock:
+            cur = self._db.execute(
+                'SELECT fallback, fallback_error FROM blobs WHERE path = ?;',
+                [relpath(path, self._dir)])
+            row = cur.fetchone()
+        if row is None:
+            return None, None
+        fallback, error = row
+        if fallback is not None:
+            fallback = join(self._dir, fallback)
+            if not exists(fallback):
+                fallback = None
+        return fallback, error
+
+    def set_fallback(self, path: str, fallback: Optional[str],
+                     error: Optional[str] = None):
+        # Record the converted file of path, or the error of the conversion.
+        size = None
+        if fallback is not None:
+            size = getsize(fallback)
+            fallback = relpath(fallback, self._dir)
+        with self._lock:
+            self._db.execute(
+                'UPDATE blobs SET fallback = ?, fallback_size = ?, fallback_error = ? WHERE path = ?;',  # noqa: E501
+                [fallback, size, error, relpath(path, self._dir)])
+            self._db.commit()
+
+    def clear_fallback_errors(self):
+        # Failed conversions are tried again.
+        with self._lock:
+            self._db.execute('UPDATE blobs SET fallback_error = NULL WHERE fallback_error IS NOT NULL;')  # noqa: E501
+            self._db.commit()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            cur = self._db.execute('SELECT value FROM meta WHERE key = ?;',
+                                   [key])
+            row = cur.fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?);',
+                             [key, value])
+            self._db.commit()
+
+
+def get_image_cache(cfg: Config) -> ImageCache:
+    with _lock:
+        if cfg.img_cache_dir not in _caches:
+            _caches[cfg.img_cache_dir] = ImageCache(cfg)
+        return _caches[cfg.img_cache_dir]
+
+
+def get_image(cfg: Config, url: str) -> CachedImage:
+    cache = get_image_cache(cfg)
+    image = cache.find(url)
+    if image is None:
+        data = try_fetch(cfg, url)
+        image = cache.add(url, data)
+        progress.image(len(data))
+    return image
+
+
+def get_cache(cfg: Config, url: str):
+    return get_image(cfg, url).path
+
+
+def _remove_pending(url: str):
+    with _lock:
+        _pending.pop(url, None)
+
+
+def prefetch(cfg: Config, urls: Iterable[str]) -> Tuple[int, List[str]]:
+    # Download images which are not in the cache concurrently. Return the
+    # number of images downloaded and URLs failed by this call. Downloads
+    # started by other calls are waited for but not counted. get_image
+    # raises the error again when the image is used.
+    global _executor
+    cache = get_image_cache(cfg)
+    urls = [url for url in dict.fromkeys(urls)
+            if url and cache.find(url) is None]
+    futures = []
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(cfg.download_threads)
+        for url in urls:
+            future = _pending.get(url)
+            own = future is None
+            if own:
+                future = _executor.submit(get_image, cfg, url)
+                _pending[url] = future
+                future.add_done_callback(
+                    lambda _, url=url: _remove_pending(url))
+            futures.append((url, future, own))
+    fetched = 0
+    failed = []
+    for url, future, own in futures:
+        try:
+            with stage('image.wait'):
+                future.result()
+            fetched += own
+        except Exception:
+            if own:
+                failed.append(url)
+    return fetched, failed
@@ -1,48 +1,108 @@
-from os.path import isdir, join
-from os import listdir
+from os.path import abspath, isdir, join
+from os import scandir
+import os
 from db import CwmDb
 from zipfile import ZipFile
 from base64 import b64decode
+from time import perf_counter
+from typing import List, Optional
 
 
-def import_keys(key: str, db: CwmDb, force=False):
+# Number of keys inserted by one executemany call.
+BATCH_SIZE = 10000
+
+
+def list_key_files(key: str, z: ZipFile = None):
+    # Return ({file name: (size, stamp)}, contain_dir_name). stamp is mtime
+    # in nanoseconds for a directory and CRC32 for a zip file.
+    files = {}
+    if z is None:
+        with scandir(key) as it:
+            for entry in it:
+                if entry.is_file():
+                    st = entry.stat()
+                    files[entry.name] = (st.st_size, st.st_mtime_ns)
+        return files, False
+    infos = z.infolist()
+    contain_dir_name = any(i.filename == 'Y2hlcy8/' for i in infos)
+    for i in infos:
+        name = i.filename
+        if contain_dir_name:
+            if not name.startswith('Y2hlcy8/') or name == 'Y2hlcy8/':
+                continue
+            name = name[8:]
+        files[name] = (i.file_size, i.CRC)
+    return files, contain_dir_name
+
+
+def import_keys(key: str, db: CwmDb, force=False,
+                names: Optional[List[str]] = None):
+    # names limits the import to these files of a key directory, so the
+    # whole directory is not listed.
     is_zip = False
-    file_list = []
     contain_dir_name = False
-    if isdir(key):
-        file_list = listdir(key)
+    if isdir(key) and names is not None:
+        files = {}
+        for name in names:
+            try:
+                st = os.stat(join(key, name))
+            except OSError:
+                continue
+            files[name] = (st.st_size, st.st_mtime_ns)
+    elif isdir(key):
+        files, _ = list_key_files(key)
     else:
         z = ZipFile(key)
         is_zip = True
-        file_list = z.namelist()
-        if 'Y2hlcy8/' in file_list:
-            contain_dir_name = True
-            file_list = [i[8:] for i in file_list if i.startswith(
-                'Y2hlcy8/') and i != 'Y2hlcy8/']
+        files, contain_dir_name = list_key_files(key, z)
     try:
-        count = 0
-        keys = db.get_all_keys_as_origin()
-        for i in file_list:
-            oid = b64decode(i).decode()
-            if oid in keys:
-                if not force:
+        with db.bulk():
+            start = perf_counter()
+            source = abspath(key)
+            # Files already imported and not changed since then are skipped
+            # even if force is True.
+            known = db.get_key_sources(source)
+            imported = {}
+            batch = []
+            count = 0
+            keys = db.get_all_key_ids()
+            for i, stat in files.items():
+                if known.get(i) == stat:
+                    continue
+                oid = b64decode(i).decode()
+                cid = int(oid[0:9])
+                uid = int(oid[9:])
+                exists = (cid, uid) in keys
+                if exists and not force:
+                    # The key is in the database already, so the file
+                    # counts as imported.
+                    imported[i] = stat
                     continue
-            cid = int(oid[0:9])
-            uid = int(oid[9:])
-            if is_zip:
-                if contain_dir_name:
-                    path = 'Y2hlcy8/' + i
+                if is_zip:
+                    if contain_dir_name:
+                        path = 'Y2hlcy8/' + i
+                    else:
+                        path = i
+                    content = z.read(path).decode()
                 else:
-                    path = i
-                content = z.read(path).decode()
-            else:
-                content = open(join(key, i), 'r', encoding='UTF-8').read()
-            if oid in keys and content == keys[oid]:
-                continue
-            db.add_key(cid, uid, content)
-            count += 1
-        print(f'Imported {count} keys.')
+                    with open(join(key, i), 'r', encoding='UTF-8') as f:
+                        content = f.read()
+                imported[i] = stat
+                if exists and content == db.get_key_with_user(cid, uid):
+                    continue
+                batch.append((cid, uid, content))
+                count += 1
+                if len(batch) >= BATCH_SIZE:
+                    db.add_keys(batch)
+                    batch = []
+            db.add_keys(batch)
+            db.set_key_sources(source, imported)
+            db.remove_key_sources(source, [
+                i for i in known if i not in files and (
+                    names is None or i in names)])
+            t = perf_counter() - start
+            rate = count / t if t > 0 else 0
+            print(f'Imported {count} keys in {t:.2f}s ({rate:.0f} keys/s).')
     finally:
-        db.commit()
         if is_zip:
             z.close()
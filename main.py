@@ -3,7 +3,9 @@ from config import Config
 from db import CwmDb
 from novelCiwei import NovelCiwei
 from booksnew import BooksNew
-from utils import parse_bool
+from utils import parse_bool, parse_size
+import os
+import sys
 
 
 parser = ArgumentParser(description='A tool to export CiWeiMao novel cache.')
@@ -11,14 +13,22 @@ parser.add_argument('-c', '--config', help='The path of the config file.', defau
 parser.add_argument('-d', '--db', help='The path of the database file.', metavar='PATH')  # noqa: E501
 parser.add_argument('-k', '--key', help='The path to Y2hlcy8 key directory or zip file.', metavar='PATH')  # noqa: E501
 parser.add_argument('--cwmdb', help='The path to NovelCiwei file.', metavar='PATH')  # noqa: E501
+parser.add_argument('--snapshot', '--cwmdb-snapshot', help='Copy NovelCiwei to this indexed local database and query the copy. The copy is refreshed when NovelCiwei changes.', dest='cwmdb_snapshot', metavar='PATH')  # noqa: E501
 parser.add_argument('-b', '--booksnew', help='The path to booksnew directory or zip file.', metavar='PATH')  # noqa: E501
 parser.add_argument('-C', '--cid', '--chapter-id', help='The chapter id.', type=int, metavar='ID')  # noqa: E501
 parser.add_argument('--ect', '--export-chapter-template', help='The template of the exported chapter. Available key: <book_id>, <chapter_id> eta.', metavar='PATH')  # noqa: E501
 parser.add_argument('-r', '--real', help='Use default locations. Needed running on Android machine. Root is required.', action='store_true')  # noqa: E501
 parser.add_argument('-B', '--bid', '--book-id', help='The book id.', type=int, metavar='ID')  # noqa: E501
-parser.add_argument('-t', '--type', help='Export type. Available types: epub, txt. Default: epub,txt')  # noqa: E501
+parser.add_argument('-t', '--type', help='Export type. Available types: epub, txt, txt.gz, txt.xz, txt.zst, sqlite, jsonl. sqlite adds chapters to the full-text search database. jsonl writes a JSON record of each chapter to stdout. Default: epub,txt')  # noqa: E501
+parser.add_argument('--jsonl-output', help='Write jsonl records to PATH instead of stdout. - means stdout. Default: -', metavar='PATH')  # noqa: E501
+parser.add_argument('--search-db', help='Path to the full-text search database. Default: exported/search.db', metavar='PATH')  # noqa: E501
+parser.add_argument('-q', '--query', help='Text to search for. Every word must be found in the chapter.', metavar='TEXT')  # noqa: E501
+parser.add_argument('--search-limit', help='Maximum number of search results. Default: 20', type=int, metavar='N')  # noqa: E501
+parser.add_argument('--vault', help='Keep decrypted chapters compressed in the database at PATH, so chapters whose encrypted content is not changed are not decrypted again. An empty string disables it. Default: disabled', metavar='PATH')  # noqa: E501
+parser.add_argument('--compress-level', help='Compression level of txt.gz, txt.xz and txt.zst files, and of exported chapters whose template ends with .gz, .xz or .zst. Default: 9 for gzip, 6 for xz, 3 for zstd', type=int, metavar='LEVEL')  # noqa: E501
 parser.add_argument('--ebt', '--export-book-template', help='The template of the exported book. Available key: <ext>, <book_id>, <book_name>, <author_name> eta.', metavar='TEMPLATE')  # noqa: E501
 parser.add_argument('--icd', '--image-cache-dir', help='Path to image cache directory.', metavar='PATH')  # noqa: E501
+parser.add_argument('--image-cache-size', help='Maximum size of the image cache, like 500M or 2G. Images not used recently are removed when the cache is larger. Default: 0 (unlimited)', type=parse_size, metavar='SIZE')  # noqa: E501
 parser.add_argument('-s', '--page-size', help='Maximum size of a page when asking for choices.', type=int, metavar='SIZE')  # noqa: E501
 parser.add_argument('-a', '--export-nodownload', help='export not downloaded chapter when exporting book.', type=parse_bool, metavar='BOOL')  # noqa: E501
 parser.add_argument('-i', '--image-type', help='How to handle images in EPUB. Available types: inline, footnote. Default: inline', choices=['inline', 'footnote'], metavar='TYPE')  # noqa: E501
@@ -26,7 +36,38 @@ parser.add_argument('-f', '--force', help='Force import keys.', action='store_tr
 parser.add_argument('-D', '--division-id', help='The division id.', type=int, metavar='ID')  # noqa: E501
 parser.add_argument('-l', '--linear', help='Mark as linear.', type=parse_bool, metavar='BOOL', default=False)  # noqa: E501
 parser.add_argument('-A', '--add-images-to-single-page', help='Add images to single page.', type=parse_bool, metavar='BOOL')  # noqa: E501
-parser.add_argument('action', help='The action to do.', choices=['importkey', 'exportchapter', 'exportbook', 'export', 'exportall', 'markaslinear', 'ik', 'ec', 'eb', 'e', 'ea', 'mal'], nargs='?', default='export')  # noqa: E501
+parser.add_argument('-j', '--jobs', help='Number of processes used to export books when exporting all books. Default: 1', type=int, metavar='N')  # noqa: E501
+parser.add_argument('-T', '--threads', help='Number of threads used to read, decrypt and render chapters of a book. Default: 4', type=int, metavar='N')  # noqa: E501
+parser.add_argument('-S', '--streaming-epub', help='Write chapters and images into the EPUB file as soon as they are exported to reduce memory usage. Default: false', type=parse_bool, metavar='BOOL')  # noqa: E501
+parser.add_argument('--download-threads', help='Number of threads used to download images. Default: 8', type=int, metavar='N')  # noqa: E501
+parser.add_argument('--host-connections', help='Maximum number of concurrent downloads from one host. Default: 4', type=int, metavar='N')  # noqa: E501
+parser.add_argument('--transcode-jobs', help='Number of ffmpeg processes used to convert WebP images to JPEG. Default: 4', type=int, metavar='N')  # noqa: E501
+parser.add_argument('-I', '--incremental', help='Skip books which are not changed since last export when exporting all books. Default: true', type=parse_bool, metavar='BOOL')  # noqa: E501
+parser.add_argument('-P', '--progress', help='Show progress of exports in the terminal. Default: false', type=parse_bool, metavar='BOOL')  # noqa: E501
+parser.add_argument('--progress-log', help='Write progress events of exports to PATH as JSON lines. - means stderr.', metavar='PATH')  # noqa: E501
+parser.add_argument('--profile', help='Time each stage of the action, count SQL statements and record the peak memory of each book, and write the report to PATH as JSON.', metavar='PATH')  # noqa: E501
+parser.add_argument('--watch-delay', help='Seconds to wait for more new files before exporting changes in watch. Default: 2', type=float, metavar='SECONDS')  # noqa: E501
+parser.add_argument('--watch-interval', help='Seconds between scans of booksnew and the key directory in watch if inotify is not available. Default: 10', type=float, metavar='SECONDS')  # noqa: E501
+parser.add_argument('action', help='The action to do.', choices=['importkey', 'exportchapter', 'exportbook', 'export', 'exportall', 'markaslinear', 'ik', 'ec', 'eb', 'e', 'ea', 'mal', 'warmimagecache', 'wic', 'search', 'watch'], nargs='?', default='export')  # noqa: E501
+EXPORT_TYPES = ['epub', 'txt', 'txt.gz', 'txt.xz', 'txt.zst', 'sqlite',
+                'jsonl']
+
+
+def check_export_type(cfg: Config):
+    # Fail before any book is exported.
+    types = [t.strip() for t in cfg.export_type.split(',') if t.strip()]
+    for t in types:
+        if t not in EXPORT_TYPES:
+            raise ValueError(f'Unsupported export type: {t}')
+    if len([t for t in types if t.startswith('txt')]) > 1:
+        raise ValueError('Only one of txt, txt.gz, txt.xz and txt.zst can be exported.')  # noqa: E501
+    if not types:
+        raise ValueError('At least one export type should be specified.')
+    if 'txt.zst' in types:
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise ValueError('zstandard is required to export txt.zst.')
 
 
 def main(args=None):
@@ -38,6 +79,15 @@ def main(args=None):
         arg.key = f'{base_dir}files/Y2hlcy8'
         arg.booksnew = f'{base_dir}files/novelCiwei/reader/booksnew'
     cfg.add_args(arg)
+    if cfg.profile is not None:
+        import profiler
+        profiler.enable()
+    if cfg.progress or cfg.progress_log is not None:
+        import progress
+        progress.enable(cfg.progress_log, cfg.progress)
+    if cfg.export_jsonl and arg.action in ['exportbook', 'eb', 'export', 'e', 'exportall', 'ea', 'watch']:  # noqa: E501
+        from export import close_jsonl, open_jsonl
+        open_jsonl(cfg)
     try:
         db = CwmDb(cfg.db)
         if arg.action == 'importkey' or arg.action == 'ik':
@@ -48,7 +98,7 @@ def main(args=None):
         elif arg.action == 'exportchapter' or arg.action == 'ec':
             if cfg.cwmdb is None:
                 raise ValueError('The cwmdb is not specified.')
-            ncw = NovelCiwei(cfg.cwmdb)
+            ncw = NovelCiwei(cfg.cwmdb, cfg.cwmdb_snapshot)
             if cfg.booksnew is None:
                 raise ValueError('The booksnew is not specified.')
             bn = BooksNew(cfg.booksnew)
@@ -59,46 +109,81 @@ def main(args=None):
         elif arg.action == 'exportbook' or arg.action == 'eb':
             if cfg.cwmdb is None:
                 raise ValueError('The cwmdb is not specified.')
-            ncw = NovelCiwei(cfg.cwmdb)
+            ncw = NovelCiwei(cfg.cwmdb, cfg.cwmdb_snapshot)
             if cfg.booksnew is None:
                 raise ValueError('The booksnew is not specified.')
             bn = BooksNew(cfg.booksnew)
             if cfg.book_id is None:
                 raise ValueError('The book id is not specified.')
-            if not cfg.export_epub and not cfg.export_txt:
-                raise ValueError('At least one export type should be specified.')  # noqa: E501
+            check_export_type(cfg)
             from export import export_book
             export_book(ncw, db, cfg, bn, cfg.book_id)
         elif arg.action == 'export' or arg.action == 'e':
             if cfg.cwmdb is None:
                 raise ValueError('The cwmdb is not specified.')
-            ncw = NovelCiwei(cfg.cwmdb)
+            ncw = NovelCiwei(cfg.cwmdb, cfg.cwmdb_snapshot)
             if cfg.booksnew is None:
                 raise ValueError('The booksnew is not specified.')
             bn = BooksNew(cfg.booksnew)
-            if not cfg.export_epub and not cfg.export_txt:
-                raise ValueError('At least one export type should be specified.')  # noqa: E501
+            check_export_type(cfg)
             from export import ExportCli
             export = ExportCli(ncw, db, cfg, bn)
             export.start()
         elif arg.action == "exportall" or arg.action == "ea":
             if cfg.cwmdb is None:
                 raise ValueError('The cwmdb is not specified.')
-            ncw = NovelCiwei(cfg.cwmdb)
+            ncw = NovelCiwei(cfg.cwmdb, cfg.cwmdb_snapshot)
             if cfg.booksnew is None:
                 raise ValueError('The booksnew is not specified.')
             bn = BooksNew(cfg.booksnew)
-            if not cfg.export_epub and not cfg.export_txt:
-                raise ValueError('At least one export type should be specified.')  # noqa: E501
+            check_export_type(cfg)
             from export import export_all
             export_all(ncw, db, cfg, bn)
+        elif arg.action == 'warmimagecache' or arg.action == 'wic':
+            if cfg.cwmdb is None:
+                raise ValueError('The cwmdb is not specified.')
+            ncw = NovelCiwei(cfg.cwmdb, cfg.cwmdb_snapshot)
+            if cfg.booksnew is None:
+                raise ValueError('The booksnew is not specified.')
+            bn = BooksNew(cfg.booksnew)
+            from export import warm_image_cache
+            warm_image_cache(ncw, db, cfg, bn)
+        elif arg.action == 'watch':
+            if cfg.cwmdb is None:
+                raise ValueError('The cwmdb is not specified.')
+            ncw = NovelCiwei(cfg.cwmdb, cfg.cwmdb_snapshot)
+            if cfg.booksnew is None:
+                raise ValueError('The booksnew is not specified.')
+            if cfg.key is None:
+                raise ValueError('The key is not specified.')
+            bn = BooksNew(cfg.booksnew)
+            check_export_type(cfg)
+            from watch import watch
+            watch(ncw, db, cfg, bn)
+        elif arg.action == 'search':
+            if cfg.query is None:
+                raise ValueError('The query is not specified.')
+            from search import search
+            search(cfg, cfg.query)
         elif arg.action == 'markaslinear' or arg.action == 'mal':
             if cfg.division_id is None:
                 raise ValueError('The division id is not specified.')
             db.set_mark(cfg.division_id, cfg.linear)
     finally:
         cfg.save()
+        if cfg.export_jsonl and arg.action in ['exportbook', 'eb', 'export', 'e', 'exportall', 'ea', 'watch']:  # noqa: E501
+            close_jsonl()
+        if cfg.progress or cfg.progress_log is not None:
+            progress.close()
+        if cfg.profile is not None:
+            profiler.write_report(cfg.profile, arg.action)
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except BrokenPipeError:
+        # The reader of jsonl records exited. Python would fail to flush
+        # stdout again when exiting.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+        sys.exit(1)
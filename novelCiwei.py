@@ -1,29 +1,178 @@
 import sqlite3
 import json
+import os
+from pathlib import Path
+from typing import Dict, Optional
+from profiler import trace_sql
+
+
+# Tables copied into the snapshot.
+SNAPSHOT_TABLES = ['catalog1', 'division', 'shelf_book_info', 'read_history']
+# ID columns stored as INTEGER in the snapshot.
+SNAPSHOT_INTEGER_COLUMNS = ['book_id', 'chapter_id', 'division_id']
+SNAPSHOT_INDEXES = [
+    'CREATE INDEX catalog1_book ON catalog1(book_id, chapter_index);',
+    'CREATE INDEX catalog1_chapter ON catalog1(chapter_id);',
+    'CREATE INDEX catalog1_division ON catalog1(book_id, division_id, chapter_index);',  # noqa: E501
+    'CREATE INDEX catalog1_download ON catalog1(is_download, book_id);',
+    'CREATE INDEX division_book ON division(book_id, division_index);',
+    'CREATE INDEX shelf_book_info_book ON shelf_book_info(book_id);',
+    'CREATE INDEX read_history_book ON read_history(book_id);',
+    'CREATE INDEX read_history_readtime ON read_history(readtime);',
+]
+SNAPSHOT_TABLE = '''CREATE TABLE snapshot (
+source TEXT,
+stamp TEXT
+);'''
 
 
 class NovelCiwei:
-    def __init__(self, db_path: str):
-        self._db = sqlite3.connect(db_path, check_same_thread=False)
+    def __init__(self, db_path: str, snapshot: Optional[str] = None):
+        self._path = db_path
+        self._snapshot = snapshot
+        self._db = None
+        # Type of ID parameters. IDs are TEXT in the app's database.
+        self._id = int if snapshot else str
+        # Parsed book_info of shelf_book_info and read_history by book_id
+        self._shelf_books = None
+        self._history_books = None
+        self.refresh()
 
-    def get_book_in_shelf(self, book_id: int):
-        cur = self._db.execute(
-            'SELECT book_info FROM shelf_book_info WHERE book_id = ?;',
-            [str(book_id)])
+    def refresh(self):
+        # Rebuild the snapshot if the app's database changed.
+        if self._snapshot is None:
+            self._shelf_books = None
+            self._history_books = None
+            if self._db is None:
+                self._db = sqlite3.connect(self._path,
+                                           check_same_thread=False)
+                trace_sql(self._db, 'novelCiwei')
+            return
+        source = os.path.abspath(self._path)
+        stamp = self.__source_stamp()
+        if self._db is not None:
+            if self.__read_snapshot_stamp(self._db) == [source, stamp]:
+                return
+            self._db.close()
+            self._db = None
+        self._shelf_books = None
+        self._history_books = None
+        if os.path.exists(self._snapshot):
+            db = sqlite3.connect(self._snapshot, check_same_thread=False)
+            try:
+                if self.__read_snapshot_stamp(db) == [source, stamp]:
+                    self._db = db
+                    trace_sql(self._db, 'novelCiwei')
+                    return
+            except sqlite3.DatabaseError:
+                pass
+            db.close()
+        self.__create_snapshot(source, stamp)
+        self._db = sqlite3.connect(self._snapshot, check_same_thread=False)
+        trace_sql(self._db, 'novelCiwei')
+
+    def __source_stamp(self):
+        # The app uses WAL, so recent changes may only be in the -wal file.
+        stamp = []
+        for path in [self._path, self._path + '-wal']:
+            if os.path.exists(path):
+                st = os.stat(path)
+                stamp.append([st.st_size, st.st_mtime_ns])
+            else:
+                stamp.append(None)
+        return json.dumps(stamp)
+
+    def __read_snapshot_stamp(self, db: sqlite3.Connection):
+        try:
+            cur = db.execute('SELECT source, stamp FROM snapshot;')
+        except sqlite3.OperationalError:
+            return None
         for i in cur:
-            return json.loads(i[0])
+            return list(i)
+
+    def __create_snapshot(self, source: str, stamp: str):
+        tmp = f'{self._snapshot}.{os.getpid()}.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        db = sqlite3.connect(tmp, uri=True)
+        try:
+            # Only the needed tables are copied from the app's database,
+            # which is opened read-only.
+            db.execute('ATTACH DATABASE ? AS src;',
+                       [Path(source).as_uri() + '?mode=ro'])
+            for table in SNAPSHOT_TABLES:
+                cols = db.execute(f'PRAGMA src.table_info("{table}");').fetchall()  # noqa: E501
+                defs = []
+                for col in cols:
+                    typ = col[2]
+                    if col[1] in SNAPSHOT_INTEGER_COLUMNS:
+                        typ = 'INTEGER'
+                    defs.append(f'"{col[1]}" {typ}')
+                # Inserting into INTEGER columns converts numeric text.
+                db.execute(f'CREATE TABLE main."{table}" ({", ".join(defs)});')  # noqa: E501
+                db.execute(f'INSERT INTO main."{table}" SELECT * FROM src."{table}";')  # noqa: E501
+            db.commit()
+            db.execute('DETACH DATABASE src;')
+            for index in SNAPSHOT_INDEXES:
+                db.execute(index)
+            db.execute(SNAPSHOT_TABLE)
+            db.execute('INSERT INTO snapshot VALUES (?, ?);', [source, stamp])
+            db.execute('ANALYZE;')
+            db.commit()
+            db.close()
+            os.replace(tmp, self._snapshot)
+        except Exception:
+            db.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def get_book(self, book_id: int):
+        return self.get_book_in_shelf(book_id) or self.get_book_in_readhistory(book_id)  # noqa: E501
+
+    def get_book_in_shelf(self, book_id: int):
+        return self.get_shelf_books().get(int(book_id))
 
     def get_book_in_readhistory(self, book_id: int):
-        cur = self._db.execute(
-            'SELECT book_info FROM read_history WHERE book_id = ?;',
-            [str(book_id)])
-        for i in cur:
-            return json.loads(i[0])
+        return self.get_history_books().get(int(book_id))
+
+    def get_shelf_books(self) -> Dict[int, dict]:
+        if self._shelf_books is None:
+            self._shelf_books = self.__load_books(
+                'SELECT book_id, book_info FROM shelf_book_info;')
+        return self._shelf_books
+
+    def get_history_books(self) -> Dict[int, dict]:
+        # Ordered by read time, latest first.
+        if self._history_books is None:
+            self._history_books = self.__load_books(
+                'SELECT book_id, book_info FROM read_history ORDER BY readtime DESC;')  # noqa: E501
+        return self._history_books
+
+    def __load_books(self, sql: str):
+        books = {}
+        for book_id, book_info in self._db.execute(sql):
+            book_id = int(book_id)
+            if book_id not in books:
+                books[book_id] = json.loads(book_info)
+        return books
 
     def get_all_books(self):
         cur = self._db.execute('SELECT book_id, COUNT(*) FROM catalog1 WHERE is_download = 1 GROUP BY book_id;')  # noqa: E501
         return cur.fetchall()
 
+    def get_all_chapters(self):
+        cur = self._db.execute(
+            'SELECT * FROM catalog1 ORDER BY book_id, chapter_index;')
+        cur.row_factory = sqlite3.Row
+        return cur
+
+    def get_all_divisions(self):
+        cur = self._db.execute(
+            'SELECT * FROM division ORDER BY book_id, division_index;')
+        cur.row_factory = sqlite3.Row
+        return cur
+
     def get_books(self):
         cur = self._db.execute('SELECT * FROM shelf_book_info;')
         cur.row_factory = sqlite3.Row
@@ -32,25 +181,26 @@ class NovelCiwei:
     def get_chapter_with_bookid(self, book_id: int):
         cur = self._db.execute(
             'SELECT * FROM catalog1 WHERE book_id = ? ORDER BY chapter_index;',
-            [str(book_id)])
+            [self._id(book_id)])
         cur.row_factory = sqlite3.Row
         return cur.fetchall()
 
     def get_chapter_with_bookid_division(self, book_id: int, division_id: int):
         cur = self._db.execute(
             'SELECT * FROM catalog1 WHERE book_id = ? AND division_id = ? AND is_download = 1 ORDER BY chapter_index;',  # noqa: E501
-            [str(book_id), str(division_id)])
+            [self._id(book_id), self._id(division_id)])
         cur.row_factory = sqlite3.Row
         return cur.fetchall()
 
     def get_divisions_with_bookid(self, book_id: int):
-        cur = self._db.execute('SELECT * FROM division WHERE book_id = ? ORDER BY division_index;', [str(book_id)])  # noqa: E501
+        cur = self._db.execute('SELECT * FROM division WHERE book_id = ? ORDER BY division_index;', [self._id(book_id)])  # noqa: E501
         cur.row_factory = sqlite3.Row
         return cur.fetchall()
 
     def get_chapter(self, chapter_id: int):
         cur = self._db.execute(
-            'SELECT * FROM catalog1 WHERE chapter_id = ?;', [str(chapter_id)])
+            'SELECT * FROM catalog1 WHERE chapter_id = ?;',
+            [self._id(chapter_id)])
         cur.row_factory = sqlite3.Row
         return cur.fetchone()
 
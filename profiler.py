@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Optional
+import json
+import re
+import sqlite3
+import tracemalloc
+
+
+# Stage timers and SQL statement counts used by --profile. Nothing is
+# recorded until enable is called.
+enabled = False
+_lock = Lock()
+_started = None
+_start_time = None
+# name -> [count, total seconds]
+_stages: Dict[str, list] = {}
+# database name -> statement -> count
+_sql: Dict[str, Dict[str, int]] = {}
+# book_id -> record of the book
+_books: Dict[str, dict] = {}
+# Books are exported one by one in a process, so stages run by any thread
+# are counted for the current book.
+_book: Optional[dict] = None
+_book_start = None
+# Traced statements have their parameters expanded. Literals are replaced
+# by ?, and lists of IN (?, ?, ...) of different length are counted as one
+# statement.
+LITERALS = re.compile(r"[xX]?'(?:[^']|'')*'|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")  # noqa: E501
+PLACEHOLDERS = re.compile(r'\?(?:\s*,\s*\?)+')
+
+
+def enable():
+    global enabled, _started, _start_time
+    if enabled:
+        return
+    enabled = True
+    _started = datetime.now().astimezone().isoformat(timespec='seconds')
+    _start_time = perf_counter()
+    tracemalloc.start()
+    from novelCiwei import NovelCiwei
+    from db import CwmDb
+    from booksnew import BooksNew
+    instrument(NovelCiwei, 'novelCiwei')
+    instrument(CwmDb, 'cwm')
+    instrument(BooksNew, 'booksnew')
+
+
+def instrument(cls, name: str):
+    # Time every public method of cls.
+    for key, value in list(vars(cls).items()):
+        if key.startswith('_') or not callable(value):
+            continue
+        setattr(cls, key, timed(f'{name}.{key}')(value))
+
+
+def timed(name: str):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _add(stages: Dict[str, list], name: str, count: int, total: float):
+    if name in stages:
+        stages[name][0] += count
+        stages[name][1] += total
+    else:
+        stages[name] = [count, total]
+
+
+@contextmanager
+def stage(name: str):
+    if not enabled:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        t = perf_counter() - start
+        with _lock:
+            _add(_stages, name, 1, t)
+            if _book is not None:
+                _add(_book['stages'], name, 1, t)
+
+
+def trace_sql(db: sqlite3.Connection, name: str):
+    # Count statements executed on db.
+    if not enabled:
+        return
+
+    def callback(statement: str):
+        statement = LITERALS.sub('?', ' '.join(statement.split()))
+        statement = PLACEHOLDERS.sub('?, ...', statement)
+        with _lock:
+            for sql in [_sql] + ([_book['sql']] if _book is not None else []):
+                counts = sql.setdefault(name, {})
+                counts[statement] = counts.get(statement, 0) + 1
+    db.set_trace_callback(callback)
+
+
+def begin_book(book_id: int):
+    global _book, _book_start
+    if not enabled:
+        return
+    tracemalloc.reset_peak()
+    _book_start = perf_counter()
+    with _lock:
+        _book = {'wall': 0, 'peak_memory': 0, 'stages': {}, 'sql': {}}
+        _books[str(book_id)] = _book
+
+
+def end_book():
+    global _book
+    if not enabled or _book is None:
+        return
+    with _lock:
+        _book['wall'] = perf_counter() - _book_start
+        _book['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        _book = None
+
+
+def pop_books() -> Dict[str, dict]:
+    # Take the records of books, to send them from a worker process.
+    global _books
+    with _lock:
+        books = _books
+        _books = {}
+    return books
+
+
+def merge_books(books: Dict[str, dict]):
+    # Add records of books exported by a worker process.
+    with _lock:
+        for book_id, book in books.items():
+            _books[book_id] = book
+            for name, (count, total) in book['stages'].items():
+                _add(_stages, name, count, total)
+            for db, counts in book['sql'].items():
+                sql = _sql.setdefault(db, {})
+                for statement, count in counts.items():
+                    sql[statement] = sql.get(statement, 0) + count
+
+
+def get_report(action: str) -> dict:
+    def stages(d: Dict[str, list]):
+        return {name: {'count': count, 'total': total}
+                for name, (count, total) in sorted(
+                    d.items(), key=lambda x: x[1][1], reverse=True)}
+    with _lock:
+        # The peak is reset at the start of each book.
+        peak = max([tracemalloc.get_traced_memory()[1]] +
+                   [book['peak_memory'] for book in _books.values()])
+        return {
+            'action': action, 'started': _started,
+            'wall': perf_counter() - _start_time, 'peak_memory': peak,
+            'stages': stages(_stages), 'sql': _sql,
+            'books': {book_id: dict(book, stages=stages(book['stages']))
+                      for book_id, book in _books.items()}}
+
+
+def write_report(path: str, action: str):
+    with open(path, 'w', encoding='UTF-8') as f:
+        json.dump(get_report(action), f, ensure_ascii=False, indent=1)
+    print(f'Wrote profile to {path}.')
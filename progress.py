@@ -0,0 +1,220 @@
+from threading import Lock
+from time import perf_counter, time
+from typing import Optional
+import json
+import os
+import sys
+
+
+# Progress of exports. Events are written as JSON lines to a file or
+# stderr, and a status line is shown in the terminal. Nothing is done until
+# enable is called.
+enabled = False
+_lock = Lock()
+_log = None
+_display = False
+_tty = False
+_start = 0
+_books_total = 0
+_books_done = 0
+_book_id = None
+_book_start = 0
+_book_chapters = 0
+_book_chapters_done = 0
+_chapters = 0
+_bytes = 0
+_images = 0
+_image_bytes = 0
+_chapter_id = None
+_last_event = 0
+_last_display = 0
+# Seconds between progress events
+EVENT_INTERVAL = 1
+# Seconds between updates of the status line. It is printed as a new line
+# if stderr is not a terminal.
+DISPLAY_INTERVAL = 0.2
+LINE_INTERVAL = 10
+
+
+def enable(log: Optional[str], display: bool):
+    # log is the path of the event file, - for stderr or None.
+    global enabled, _log, _display, _tty, _start, _books_total, \
+        _books_done, _book_id, _chapters, _bytes, _images, _image_bytes, \
+        _chapter_id
+    enabled = True
+    if log == '-':
+        _log = sys.stderr
+    elif log is not None:
+        _log = open(log, 'a', encoding='UTF-8', buffering=1)
+    else:
+        _log = None
+    _display = display
+    _tty = sys.stderr.isatty()
+    _start = perf_counter()
+    _books_total = _books_done = _chapters = _bytes = _images = 0
+    _image_bytes = 0
+    _book_id = _chapter_id = None
+
+
+def close():
+    global enabled, _log
+    if not enabled:
+        return
+    clear()
+    if _log is not None and _log is not sys.stderr:
+        _log.close()
+    _log = None
+    enabled = False
+
+
+def _emit(event: str, **kwargs):
+    if _log is None:
+        return
+    if _log is sys.stderr:
+        clear()
+    data = {'event': event, 'time': round(time(), 3), 'pid': os.getpid()}
+    data.update(kwargs)
+    _log.write(json.dumps(data, ensure_ascii=False) + '\n')
+
+
+def clear():
+    # Clear the status line before other output.
+    if enabled and _display and _tty:
+        sys.stderr.write('\r\x1b[K')
+        sys.stderr.flush()
+
+
+def _format_time(t: float):
+    t = int(t)
+    return f'{t // 3600}:{t // 60 % 60:02}:{t % 60:02}'
+
+
+def _status():
+    elapsed = perf_counter() - _start
+    rate = _chapters / elapsed if elapsed > 0 else 0
+    eta = None
+    if _books_total > 1 and _books_done:
+        eta = elapsed / _books_done * (_books_total - _books_done)
+    elif _book_chapters and rate:
+        eta = (_book_chapters - _book_chapters_done) / rate
+    s = []
+    # No total when a single book is exported.
+    if _books_total:
+        s.append(f'{_books_done}/{_books_total} books')
+    if _chapters:
+        s.append(f'{_chapters} chapters {rate:.1f}/s')
+        s.append(f'{_bytes / (1 << 20):.1f} MiB')
+    if _images:
+        s.append(f'{_images} images')
+    if eta is not None:
+        s.append(f'ETA {_format_time(eta)}')
+    if _chapter_id is not None:
+        s.append(str(_chapter_id))
+    return ' | '.join(s)
+
+
+def _update(force=False):
+    global _last_event, _last_display
+    now = perf_counter()
+    if _log is not None and (force or now - _last_event >= EVENT_INTERVAL):
+        _last_event = now
+        elapsed = now - _start
+        _emit('progress', book_id=_book_id, chapter_id=_chapter_id,
+              chapters=_chapters, bytes=_bytes, images=_images,
+              image_bytes=_image_bytes, books_done=_books_done,
+              books=_books_total,
+              chapters_per_second=_chapters / elapsed if elapsed else 0)
+    if _display:
+        interval = DISPLAY_INTERVAL if _tty else LINE_INTERVAL
+        if force or now - _last_display >= interval:
+            _last_display = now
+            if _tty:
+                sys.stderr.write('\r\x1b[K' + _status())
+            else:
+                sys.stderr.write(_status() + '\n')
+            sys.stderr.flush()
+
+
+def run_start(books: int):
+    global _books_total
+    if not enabled:
+        return
+    with _lock:
+        _books_total = books
+        _emit('run_start', books=books)
+        _update(True)
+
+
+def run_end(failed: int):
+    if not enabled:
+        return
+    with _lock:
+        _emit('run_end', books=_books_total, failed=failed,
+              chapters=_chapters, bytes=_bytes, images=_images,
+              seconds=perf_counter() - _start)
+        clear()
+
+
+def book_start(book_id: int, chapters: int):
+    global _book_id, _book_start, _book_chapters, _book_chapters_done, \
+        _chapter_id
+    if not enabled:
+        return
+    with _lock:
+        _book_id = book_id
+        _chapter_id = None
+        _book_start = perf_counter()
+        _book_chapters = chapters
+        _book_chapters_done = 0
+        _emit('book_start', book_id=book_id, chapters=chapters)
+        _update(True)
+
+
+def book_end(book_id: int, error: Optional[str] = None):
+    global _book_id, _books_done, _book_start, _book_chapters, \
+        _book_chapters_done
+    if not enabled:
+        return
+    with _lock:
+        _books_done += 1
+        _emit('book_end', book_id=book_id, chapters=_book_chapters_done,
+              seconds=perf_counter() - _book_start, error=error)
+        # A book which fails before book_start counts from here.
+        _book_id = None
+        _book_start = perf_counter()
+        _book_chapters = _book_chapters_done = 0
+        _update(True)
+
+
+def book_done():
+    # A book exported by a worker process, which writes its own events.
+    global _books_done
+    if not enabled:
+        return
+    with _lock:
+        _books_done += 1
+        _update(True)
+
+
+def chapter(chapter_id: int, content: Optional[str]):
+    # content is None if the chapter is copied from the old EPUB file.
+    global _chapters, _bytes, _chapter_id, _book_chapters_done
+    if not enabled:
+        return
+    with _lock:
+        _chapters += 1
+        _book_chapters_done += 1
+        if content is not None:
+            _bytes += len(content.encode())
+        _chapter_id = int(chapter_id)
+        _update()
+
+
+def image(size: int):
+    global _images, _image_bytes
+    if not enabled:
+        return
+    with _lock:
+        _images += 1
+        _image_bytes += size
+        _update()
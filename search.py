@@ -0,0 +1,138 @@
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+from config import Config
+from db import SharedDb, get_shared_db
+import json
+
+
+# Decrypted chapters of exported books with a full-text index. The trigram
+# tokenizer matches any substring of 3 or more characters, which works for
+# Chinese text without word segmentation.
+SEARCH_TABLES = ['''CREATE TABLE IF NOT EXISTS books (
+book_id INTEGER PRIMARY KEY,
+book_name TEXT,
+author_name TEXT,
+book_info TEXT
+);''', '''CREATE TABLE IF NOT EXISTS divisions (
+division_id INTEGER PRIMARY KEY,
+book_id INTEGER,
+division_index INTEGER,
+division_name TEXT,
+description TEXT
+);''', 'CREATE INDEX IF NOT EXISTS divisions_book ON divisions(book_id);',
+                 '''CREATE TABLE IF NOT EXISTS chapters (
+chapter_id INTEGER PRIMARY KEY,
+book_id INTEGER,
+division_id INTEGER,
+chapter_index INTEGER,
+chapter_title TEXT,
+is_download INTEGER,
+hash TEXT,
+content TEXT
+);''', 'CREATE INDEX IF NOT EXISTS chapters_book ON chapters(book_id, chapter_index);',  # noqa: E501
+                 "CREATE VIRTUAL TABLE IF NOT EXISTS chapters_fts USING fts5(chapter_title, content, content='chapters', content_rowid='chapter_id', tokenize='trigram');",  # noqa: E501
+                 '''CREATE TRIGGER IF NOT EXISTS chapters_ai AFTER INSERT ON chapters BEGIN
+INSERT INTO chapters_fts(rowid, chapter_title, content) VALUES (new.chapter_id, new.chapter_title, new.content);
+END;''', '''CREATE TRIGGER IF NOT EXISTS chapters_ad AFTER DELETE ON chapters BEGIN
+INSERT INTO chapters_fts(chapters_fts, rowid, chapter_title, content) VALUES ('delete', old.chapter_id, old.chapter_title, old.content);
+END;''', '''CREATE TRIGGER IF NOT EXISTS chapters_au AFTER UPDATE OF chapter_title, content ON chapters BEGIN
+INSERT INTO chapters_fts(chapters_fts, rowid, chapter_title, content) VALUES ('delete', old.chapter_id, old.chapter_title, old.content);
+INSERT INTO chapters_fts(rowid, chapter_title, content) VALUES (new.chapter_id, new.chapter_title, new.content);
+END;''']  # noqa: E501
+# Shorter queries can not use the trigram index.
+MIN_QUERY_LENGTH = 3
+
+
+class SearchDb(SharedDb):
+    def __init__(self, path: str):
+        super().__init__(path, 'search', SEARCH_TABLES)
+
+    def has_book(self, book_id: int) -> bool:
+        with self._lock:
+            cur = self._db.execute('SELECT 1 FROM books WHERE book_id = ?;',
+                                   [int(book_id)])
+            return cur.fetchone() is not None
+
+    def set_book(self, book: dict, divisions, chapters):
+        # Update the metadata of a book. Chapters which are not in the
+        # catalog anymore are removed. Contents are kept.
+        book_id = int(book['book_id'])
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?);', [  # noqa: E501
+                book_id, book['book_name'], book['author_name'],
+                json.dumps(book, ensure_ascii=False)])
+            self._db.execute('DELETE FROM divisions WHERE book_id = ?;',
+                             [book_id])
+            self._db.executemany('INSERT INTO divisions VALUES (?, ?, ?, ?, ?);', [  # noqa: E501
+                (int(d['division_id']), book_id, d['division_index'],
+                 d['division_name'], d['description']) for d in divisions])
+            ids = [int(c['chapter_id']) for c in chapters]
+            self._db.execute('CREATE TEMP TABLE IF NOT EXISTS catalog_ids (chapter_id INTEGER PRIMARY KEY);')  # noqa: E501
+            self._db.execute('DELETE FROM catalog_ids;')
+            self._db.executemany('INSERT INTO catalog_ids VALUES (?);',
+                                 [(i,) for i in ids])
+            self._db.execute('DELETE FROM chapters WHERE book_id = ? AND chapter_id NOT IN (SELECT chapter_id FROM catalog_ids);', [book_id])  # noqa: E501
+            self._db.executemany('INSERT INTO chapters (chapter_id, book_id, division_id, chapter_index, chapter_title, is_download) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (chapter_id) DO UPDATE SET book_id = excluded.book_id, division_id = excluded.division_id, chapter_index = excluded.chapter_index, chapter_title = excluded.chapter_title, is_download = excluded.is_download WHERE (book_id, division_id, chapter_index, chapter_title, is_download) IS NOT (excluded.book_id, excluded.division_id, excluded.chapter_index, excluded.chapter_title, excluded.is_download);', [  # noqa: E501
+                (int(c['chapter_id']), book_id, int(c['division_id']),
+                 c['chapter_index'], c['chapter_title'], c['is_download'])
+                for c in chapters])
+            self._db.commit()
+
+    def get_hashes(self, book_id: int) -> Dict[int, str]:
+        # Hashes of the encrypted content of indexed chapters.
+        with self._lock:
+            cur = self._db.execute('SELECT chapter_id, hash FROM chapters WHERE book_id = ? AND hash IS NOT NULL;', [int(book_id)])  # noqa: E501
+            return dict(cur.fetchall())
+
+    def set_contents(self, items: List[Tuple[int, str, str]]):
+        # items are (chapter_id, hash, content).
+        with self._lock:
+            self._db.executemany('UPDATE chapters SET hash = ?, content = ? WHERE chapter_id = ?;', [  # noqa: E501
+                (h, content, int(chapter_id))
+                for chapter_id, h, content in items])
+            self._db.commit()
+
+    def search(self, query: str, limit: int = 20,
+               book_id: Optional[int] = None):
+        # Return (book_name, author_name, chapter_id, chapter_title,
+        # snippet) of the best matches. Every word of query must match.
+        words = query.split()
+        where = ''
+        args = []
+        if book_id is not None:
+            where = ' AND c.book_id = ?'
+            args.append(int(book_id))
+        with self._lock:
+            if words and all(len(w) >= MIN_QUERY_LENGTH for w in words):
+                match = ' '.join('"' + w.replace('"', '""') + '"'
+                                 for w in words)
+                cur = self._db.execute(f"SELECT b.book_name, b.author_name, c.chapter_id, c.chapter_title, snippet(chapters_fts, 1, '[', ']', '…', 16) FROM chapters_fts JOIN chapters c ON c.chapter_id = chapters_fts.rowid JOIN books b ON b.book_id = c.book_id WHERE chapters_fts MATCH ?{where} ORDER BY rank LIMIT ?;", [match] + args + [limit])  # noqa: E501
+                return cur.fetchall()
+            # Scan contents for short words.
+            cond = ' AND '.join(['instr(c.content, ?) > 0'] * len(words))
+            cur = self._db.execute(f'SELECT b.book_name, b.author_name, c.chapter_id, c.chapter_title, c.content FROM chapters c JOIN books b ON b.book_id = c.book_id WHERE {cond or "0"}{where} ORDER BY c.book_id, c.chapter_index LIMIT ?;', words + args + [limit])  # noqa: E501
+            return [r[:4] + (get_snippet(r[4], words[0]),) for r in cur]
+
+
+def get_snippet(content: str, word: str, size: int = 16):
+    i = content.find(word)
+    start = max(0, i - size // 2)
+    end = i + len(word) + size // 2
+    return ('…' if start else '') + content[start:i] + f'[{word}]' + \
+        content[i + len(word):end] + ('…' if end < len(content) else '')
+
+
+def get_search_db(cfg: Config) -> SearchDb:
+    return get_shared_db(SearchDb, cfg.search_db)
+
+
+def search(cfg: Config, query: str):
+    db = get_search_db(cfg)
+    start = perf_counter()
+    results = db.search(query, cfg.search_limit, cfg.book_id)
+    t = perf_counter() - start
+    for book_name, author_name, chapter_id, chapter_title, snippet in results:
+        # Chapters which are not downloaded have no content.
+        snippet = ' '.join((snippet or '').split())
+        print(f'{book_name} - {author_name} {chapter_title} ({chapter_id}): {snippet}')  # noqa: E501
+    print(f'Found {len(results)} results in {t * 1000:.1f}ms.')
@@ -0,0 +1,143 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import getpid, remove, replace, stat
+from os.path import exists, realpath, splitext
+from threading import Lock, get_ident
+from typing import Dict, Optional
+from config import Config
+from image_cache import get_image_cache
+from profiler import stage
+import json
+import shutil
+import subprocess
+
+
+# A complete JPEG file starts with SOI and ends with EOI.
+JPEG_SOI = b'\xff\xd8\xff'
+JPEG_EOI = b'\xff\xd9'
+
+have_ffmpeg = None
+# Conversions are run by a bounded pool of ffmpeg processes.
+_lock = Lock()
+_executor = None
+# Unfinished conversions by source path
+_pending: Dict[str, Future] = {}
+
+
+def reset():
+    # Drop the thread pool inherited from the parent process.
+    global _lock, _executor, _pending
+    _lock = Lock()
+    _executor = None
+    _pending = {}
+
+
+def check_ffmpeg(cfg: Config):
+    # The result is stored in the image cache index with the ffmpeg found
+    # in PATH, so ffmpeg is not started again until it changes. Failed
+    # conversions are tried again with a changed ffmpeg.
+    global have_ffmpeg
+    path = shutil.which('ffmpeg')
+    if path is None:
+        have_ffmpeg = False
+    else:
+        st = stat(path)
+        key = [realpath(path), st.st_size, st.st_mtime_ns]
+        cache = get_image_cache(cfg)
+        probe = cache.get_meta('ffmpeg')
+        probe = json.loads(probe) if probe else None
+        if probe is not None and probe[0] == key:
+            have_ffmpeg = probe[1]
+        else:
+            p = subprocess.Popen([path, '-h'], stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+            p.communicate()
+            have_ffmpeg = not p.wait()
+            cache.clear_fallback_errors()
+            cache.set_meta('ffmpeg', json.dumps([key, have_ffmpeg]))
+    if not have_ffmpeg:
+        print('Warning: Can not find ffmpeg. Some epub readers may failed to open these pictures.')  # noqa: E501
+
+
+def ensure_ffmpeg(cfg: Config):
+    with _lock:
+        if have_ffmpeg is None:
+            check_ffmpeg(cfg)
+
+
+def is_valid_jpeg(path: str) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(JPEG_SOI)) != JPEG_SOI:
+                return False
+            f.seek(-len(JPEG_EOI), 2)
+            return f.read() == JPEG_EOI
+    except OSError:
+        return False
+
+
+def perform_convert(cfg: Config, image_path: str) -> Optional[str]:
+    # Convert image_path to JPEG and return the path of the JPEG file.
+    # Results are stored in the image cache by the content of image_path,
+    # failures included.
+    cache = get_image_cache(cfg)
+    output_path, error = cache.get_fallback(image_path)
+    if output_path is not None:
+        return output_path
+    if error is not None:
+        # The error is cleared if ffmpeg changed.
+        ensure_ffmpeg(cfg)
+        output_path, error = cache.get_fallback(image_path)
+        if output_path is not None or error is not None:
+            return output_path
+    output_path = splitext(image_path)[0] + '_fallback.jpg'
+    if is_valid_jpeg(output_path):
+        cache.set_fallback(image_path, output_path)
+        return output_path
+    ensure_ffmpeg(cfg)
+    if not have_ffmpeg:
+        return None
+    # ffmpeg chooses the format by the extension.
+    tmp = f'{splitext(image_path)[0]}.{getpid()}.{get_ident()}.tmp.jpg'
+    with stage('ffmpeg'):
+        p = subprocess.Popen(['ffmpeg', '-y', '-i', image_path, tmp],
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL)
+        p.communicate()
+        code = p.wait()
+    if code:
+        error = f'Exit code: {code}'
+    elif not is_valid_jpeg(tmp):
+        error = 'Invalid JPEG file'
+    if error is not None:
+        if exists(tmp):
+            remove(tmp)
+        cache.set_fallback(image_path, None, error)
+        print(f'Warning: Can not convert images by using ffmpeg. ({error}) Some epub readers may failed to open these pictures.')  # noqa: E501
+        return None
+    replace(tmp, output_path)
+    cache.set_fallback(image_path, output_path)
+    return output_path
+
+
+def _remove_pending(image_path: str, future: Future):
+    with _lock:
+        if _pending.get(image_path) is future:
+            del _pending[image_path]
+
+
+def submit_convert(cfg: Config, image_path: str) -> Future:
+    # Convert image_path in the background. The future returns the same as
+    # perform_convert.
+    global _executor
+    with _lock:
+        future = _pending.get(image_path)
+        if future is not None:
+            return future
+        if _executor is None:
+            _executor = ThreadPoolExecutor(cfg.transcode_jobs)
+        future = _executor.submit(perform_convert, cfg, image_path)
+        _pending[image_path] = future
+    # The callback is called at once if the future is done already, so it
+    # is added without holding the lock.
+    future.add_done_callback(lambda f: _remove_pending(image_path, f))
+    return future
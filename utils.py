@@ -1,5 +1,13 @@
 from config import Config
 from math import ceil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import io
+
+
+# Buffer size of exported text files
+TEXT_BUFFER_SIZE = 1 << 20
 
 
 def ask_choice(cfg: Config, choices: list, prompt='请选择：', fn=None, extra=None):
@@ -63,3 +71,64 @@ def parse_bool(s: str):
     if s.isnumeric():
         return bool(int(s))
     raise ValueError(f"Unexpected bool value: {s}")
+
+
+def parse_size(s: str):
+    # Size in bytes with an optional K, M or G suffix.
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    t = s.strip().lower().removesuffix('b').removesuffix('i')
+    if t and t[-1] in units:
+        return int(float(t[:-1]) * units[t[-1]])
+    if t.isnumeric():
+        return int(t)
+    raise ValueError(f"Unexpected size: {s}")
+
+
+# Like map(fn, items) but runs fn in a thread pool. Results are yielded in
+# the order of items and at most window calls run ahead of the consumer.
+def ordered_map(fn, items, workers: int, window: int = None):
+    if workers <= 1:
+        for i in items:
+            yield fn(i)
+        return
+    if window is None:
+        window = workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(workers) as pool:
+        try:
+            for i in items:
+                pending.append(pool.submit(fn, i))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for f in pending:
+                f.cancel()
+
+
+def open_zstd(path: str, level: Optional[int] = None):
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('zstandard is required to write .zst files.')
+    cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+    return cctx.stream_writer(open(path, 'wb'), closefd=True)
+
+
+def open_text_file(path: str, level: Optional[int] = None):
+    # Open path to write UTF-8 text. Files ending with .gz, .xz or .zst are
+    # compressed while being written. level is the compression level.
+    if path.endswith('.gz'):
+        import gzip
+        # No timestamp, so the same content gives the same file.
+        f = gzip.GzipFile(path, 'wb', 9 if level is None else level, mtime=0)
+    elif path.endswith('.xz'):
+        import lzma
+        f = lzma.LZMAFile(path, 'wb', preset=level)
+    elif path.endswith('.zst'):
+        f = open_zstd(path, level)
+    else:
+        return open(path, 'w', encoding='UTF-8', buffering=TEXT_BUFFER_SIZE)
+    return io.TextIOWrapper(io.BufferedWriter(f, TEXT_BUFFER_SIZE),
+                            encoding='UTF-8')
@@ -0,0 +1,66 @@
+from typing import Dict, List, Optional, Tuple
+from config import Config
+from db import SharedDb, get_shared_db
+import json
+import zlib
+
+
+# Decrypted chapters compressed with zlib. A chapter is only read from the
+# vault if the hash of its encrypted content is still the same.
+VAULT_TABLES = ['''CREATE TABLE IF NOT EXISTS chapters (
+chapter_id INTEGER PRIMARY KEY,
+book_id INTEGER,
+hash TEXT,
+content BLOB
+);''', 'CREATE INDEX IF NOT EXISTS chapters_book ON chapters(book_id);']
+COMPRESS_LEVEL = 6
+
+
+class ChapterVault(SharedDb):
+    def __init__(self, path: str):
+        super().__init__(path, 'vault', VAULT_TABLES)
+        # Lost chapters are decrypted again, so commits need not be
+        # durable.
+        self._db.execute('PRAGMA synchronous = NORMAL;')
+
+    def get_hashes(self, book_id: int) -> Dict[int, str]:
+        # Hashes of the encrypted content of stored chapters of a book.
+        with self._lock:
+            cur = self._db.execute('SELECT chapter_id, hash FROM chapters WHERE book_id = ?;', [int(book_id)])  # noqa: E501
+            return dict(cur.fetchall())
+
+    def get_contents(self, items: List[Tuple[int, str]]
+                     ) -> List[Optional[str]]:
+        # items are (chapter_id, hash). None is returned for chapters which
+        # are not stored or whose hash is changed.
+        if not items:
+            return []
+        with self._lock:
+            cur = self._db.execute('SELECT chapter_id, hash, content FROM chapters WHERE chapter_id IN (SELECT value FROM json_each(?));', [json.dumps([int(i[0]) for i in items])])  # noqa: E501
+            stored = {i[0]: (i[1], i[2]) for i in cur}
+        results = []
+        for chapter_id, h in items:
+            data = stored.get(int(chapter_id))
+            if data is None or data[0] != h:
+                results.append(None)
+            else:
+                results.append(zlib.decompress(data[1]).decode())
+        return results
+
+    def set_contents(self, book_id: int, items: List[Tuple[int, str, str]]):
+        # items are (chapter_id, hash, content).
+        if not items:
+            return
+        rows = [(int(chapter_id), int(book_id), h,
+                 zlib.compress(content.encode(), COMPRESS_LEVEL))
+                for chapter_id, h, content in items]
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?);', rows)  # noqa: E501
+            self._db.commit()
+
+
+def get_vault(cfg: Config) -> Optional[ChapterVault]:
+    # None if the vault is disabled.
+    if not cfg.vault:
+        return None
+    return get_shared_db(ChapterVault, cfg.vault)
@@ -0,0 +1,285 @@
+from base64 import b64decode
+from binascii import Error as Base64Error
+from ctypes.util import find_library
+from os import scandir
+from os.path import isdir, join
+from select import select
+from time import monotonic, sleep
+from typing import Dict, Optional, Set, Tuple
+import ctypes
+import os
+import struct
+from booksnew import BooksNew
+from config import Config
+from db import CwmDb
+from key import import_keys, list_key_files
+from novelCiwei import NovelCiwei
+
+
+# Flags of inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+FILE_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+# struct inotify_event without the name
+EVENT = struct.Struct('iIII')
+BUFFER_SIZE = 1 << 16
+# Changes are exported at most this many seconds after the first one, even
+# if new files keep coming.
+MAX_DELAY = 60
+# Seconds to wait for the app to mark a new chapter as downloaded in its
+# database.
+WAIT_TIMEOUT = 600
+
+
+def parse_chapter(book: str, name: str) -> Optional[Tuple[int, int]]:
+    # (book_id, chapter_id) of booksnew/<book_id>/<chapter_id>.txt
+    if not name.endswith('.txt'):
+        return None
+    try:
+        return int(book), int(name[:-4])
+    except ValueError:
+        return None
+
+
+def parse_key(name: str) -> Optional[int]:
+    # The chapter ID of a key file.
+    try:
+        return int(b64decode(name).decode()[0:9])
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+class Changes:
+    def __init__(self):
+        # chapter_id -> book_id of new chapter files
+        self.chapters: Dict[int, int] = {}
+        # Names of new key files
+        self.keys: Set[str] = set()
+        # Events were lost, so every book should be checked.
+        self.rescan = False
+        self.first = None
+        self.last = None
+
+    def __bool__(self):
+        return bool(self.chapters or self.keys or self.rescan)
+
+    def _touch(self):
+        self.last = monotonic()
+        if self.first is None:
+            self.first = self.last
+
+    def add_chapter(self, book: str, name: str):
+        ids = parse_chapter(book, name)
+        if ids is not None:
+            self.chapters[ids[1]] = ids[0]
+            self._touch()
+
+    def add_key(self, name: str):
+        self.keys.add(name)
+        self._touch()
+
+    def set_rescan(self):
+        self.rescan = True
+        self._touch()
+
+
+class InotifyWatcher:
+    def __init__(self, booksnew: str, key: str):
+        libc = ctypes.CDLL(find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._booksnew = booksnew
+        # wd -> book directory name, '' for booksnew and None for keys
+        self._watches: Dict[int, Optional[str]] = {}
+        try:
+            self._add(booksnew, IN_CREATE | IN_MOVED_TO, '')
+            with scandir(booksnew) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        self._add(entry.path, FILE_MASK, entry.name)
+            self._add(key, FILE_MASK, None)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _add(self, path: str, mask: int, book: Optional[str]):
+        wd = self._add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self._watches[wd] = book
+
+    def close(self):
+        os.close(self._fd)
+
+    def read(self, timeout: Optional[float], changes: Changes):
+        if not select([self._fd], [], [], timeout)[0]:
+            return
+        data = os.read(self._fd, BUFFER_SIZE)
+        i = 0
+        while i < len(data):
+            wd, mask, _, size = EVENT.unpack_from(data, i)
+            name = os.fsdecode(data[i + EVENT.size:i + EVENT.size + size]
+                               .rstrip(b'\0'))
+            i += EVENT.size + size
+            if mask & IN_Q_OVERFLOW:
+                changes.set_rescan()
+                continue
+            if wd not in self._watches:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+            book = self._watches[wd]
+            if book is None:
+                changes.add_key(name)
+            elif book:
+                changes.add_chapter(book, name)
+            elif mask & IN_ISDIR:
+                # Files may be written before the watch is added.
+                path = join(self._booksnew, name)
+                self._add(path, FILE_MASK, name)
+                with scandir(path) as it:
+                    for entry in it:
+                        changes.add_chapter(name, entry.name)
+
+
+class PollWatcher:
+    # Compare sizes and mtimes of all files every interval seconds.
+    def __init__(self, booksnew: str, key: str, interval: float):
+        self._booksnew = booksnew
+        self._key = key
+        self._interval = interval
+        self._next = monotonic() + interval
+        self._chapters = self._list_chapters()
+        self._keys = list_key_files(key)[0]
+
+    def _list_chapters(self):
+        files = {}
+        with scandir(self._booksnew) as it:
+            for book in it:
+                if not book.is_dir():
+                    continue
+                with scandir(book.path) as files_it:
+                    for entry in files_it:
+                        st = entry.stat()
+                        files[(book.name, entry.name)] = (st.st_size,
+                                                          st.st_mtime_ns)
+        return files
+
+    def close(self):
+        pass
+
+    def read(self, timeout: Optional[float], changes: Changes):
+        wait = self._next - monotonic()
+        if timeout is not None and timeout < wait:
+            sleep(max(timeout, 0))
+            return
+        sleep(max(wait, 0))
+        self._next = monotonic() + self._interval
+        chapters = self._list_chapters()
+        for (book, name), stat in chapters.items():
+            if self._chapters.get((book, name)) != stat:
+                changes.add_chapter(book, name)
+        self._chapters = chapters
+        keys = list_key_files(self._key)[0]
+        for name, stat in keys.items():
+            if self._keys.get(name) != stat:
+                changes.add_key(name)
+        self._keys = keys
+
+
+def open_watcher(cfg: Config):
+    try:
+        return InotifyWatcher(cfg.booksnew, cfg.key)
+    except (OSError, AttributeError) as e:
+        # AttributeError if libc has no inotify.
+        print(f'Failed to use inotify: {e}')
+        print(f'Checking for new files every {cfg.watch_interval} seconds.')
+        return PollWatcher(cfg.booksnew, cfg.key, cfg.watch_interval)
+
+
+def export_changes(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew,
+                   changes: Changes, waiting: Dict[int, Tuple[int, float]]):
+    # waiting is chapter_id -> (book_id, time) of new chapter files which
+    # are not marked as downloaded in the app's database yet.
+    from export import export_all
+    if changes.keys:
+        import_keys(cfg.key, db, names=sorted(changes.keys))
+    ncw.refresh()
+    if changes.rescan:
+        waiting.clear()
+        export_all(ncw, db, cfg, bn)
+        return
+    now = monotonic()
+    for chapter_id, book_id in changes.chapters.items():
+        waiting[chapter_id] = (book_id, now)
+    books = set()
+    # Chapters which could not be decrypted before their keys were found.
+    for name in changes.keys:
+        chapter_id = parse_key(name)
+        if chapter_id is None or chapter_id in waiting:
+            continue
+        chapter = ncw.get_chapter(chapter_id)
+        if chapter is not None and chapter['is_download']:
+            books.add(int(chapter['book_id']))
+    for chapter_id, (book_id, t) in list(waiting.items()):
+        chapter = ncw.get_chapter(chapter_id)
+        if chapter is not None and chapter['is_download']:
+            books.add(int(chapter['book_id']))
+            del waiting[chapter_id]
+        elif now - t > WAIT_TIMEOUT:
+            print(f'Chapter {chapter_id} of book {book_id} is not downloaded in the database.')  # noqa: E501
+            del waiting[chapter_id]
+    if books:
+        export_all(ncw, db, cfg, bn, sorted(books))
+
+
+def watch(ncw: NovelCiwei, db: CwmDb, cfg: Config, bn: BooksNew):
+    # Export books when the app downloads new chapters or keys, until
+    # interrupted.
+    if not isdir(cfg.booksnew) or not isdir(cfg.key):
+        raise ValueError('The booksnew and the key should be directories.')
+    import_keys(cfg.key, db)
+    watcher = open_watcher(cfg)
+    print(f'Watching {cfg.booksnew} and {cfg.key}.')
+    changes = Changes()
+    waiting = {}
+    try:
+        while True:
+            timeout = None
+            if changes:
+                # Wait until no new files come for watch_delay seconds.
+                timeout = min(changes.last + cfg.watch_delay,
+                              changes.first + MAX_DELAY) - monotonic()
+            elif waiting:
+                timeout = cfg.watch_interval
+            if timeout is None or timeout > 0:
+                watcher.read(timeout, changes)
+                if changes and monotonic() < min(
+                        changes.last + cfg.watch_delay,
+                        changes.first + MAX_DELAY):
+                    continue
+            if not changes and not waiting:
+                continue
+            current = changes
+            changes = Changes()
+            try:
+                export_changes(ncw, db, cfg, bn, current, waiting)
+            except BrokenPipeError:
+                raise
+            except Exception as e:
+                print(f'Failed to export changes: {e}')
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+    finally:
+        watcher.close()